@@ -0,0 +1,908 @@
+"""Бенчмарки и нагрузочные проверки бота.
+
+Запуск:
+    python bench.py stress --users 1000 --purchases 20000
+    python bench.py compact
+    python bench.py draw --sizes 10000 1000000 10000000
+    python bench.py fsm --users 10000 --steps 5
+    python bench.py load --users 1000 10000 100000
+    python bench.py shards --workers 1 2 4 --users 10000
+    python bench.py startup --users 100000 --tickets 1000000
+    python bench.py tickets --sizes 100000 1000000
+    python bench.py snapshot --users 100000 --tickets 1000000
+
+Все проверки работают офлайн во временной папке и не трогают
+настоящие файлы данных.
+"""
+import argparse
+import array
+import asyncio
+import gc
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def load_bot(workdir):
+    """Импортируем бота так, чтобы все файлы данных были во workdir"""
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+    import bot
+    return bot
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+
+# ========================
+# 🔒 КОНКУРЕНТНЫЕ ПОКУПКИ
+# ========================
+
+async def stress(args):
+    """Тысячи одновременных покупок: балансы и sold_tickets должны сойтись"""
+    bot = load_bot(args.workdir)
+    store = bot.store
+    store.load()
+    await store.start()
+
+    price = 3
+    per_user_affordable = 5
+    lottery_ids = [f"stress{i}" for i in range(args.lotteries)]
+    for lottery_id in lottery_ids:
+        await store.commit({"op": "create_lottery", "lottery": {
+            "id": lottery_id,
+            "prize_count": 1,
+            "ticket_price": price,
+            "duration_seconds": 3600,
+            "lottery_text": "stress",
+            "created_at": "2024-01-01T00:00:00",
+            "ends_at": "2099-01-01T00:00:00",
+            "sold_tickets": 0,
+            "is_active": True
+        }})
+
+    users = [fake_user(1000 + i) for i in range(args.users)]
+    initial = price * per_user_affordable
+    for user in users:
+        await bot.deposit(
+            user_id=str(user.id), username=user.username, first_name=user.first_name,
+            amount=initial, charge_id=f"stress-{user.id}"
+        )
+    # Стартовое состояние — в снимок, покупки — в журнал
+    await store.compact()
+
+    rng = random.Random(args.seed)
+    attempts = [(rng.choice(lottery_ids), rng.choice(users)) for _ in range(args.purchases)]
+
+    async def attempt(lottery_id, user):
+        try:
+            await bot.purchase_tickets(lottery_id, user)
+            return True
+        except bot.PurchaseError:
+            return False
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(attempt(lottery_id, user) for lottery_id, user in attempts))
+    elapsed = time.perf_counter() - started
+    assert not await store.reconcile_ledger()
+    await store.stop()
+
+    bought = sum(results)
+    attempts_by_user = {}
+    for _, user in attempts:
+        attempts_by_user[str(user.id)] = attempts_by_user.get(str(user.id), 0) + 1
+
+    reloaded = type(store.backend)(store.backend.snapshot_path, store.backend.journal_path).load()
+    for data in (store.data, reloaded):
+        lotteries = data["active_lotteries"]
+        assert sum(l["sold_tickets"] for l in lotteries.values()) == bought
+        for lottery in lotteries.values():
+            table = lottery["tickets"]
+            assert lottery["sold_tickets"] == len(table)
+            assert len(set(table.numbers)) == len(table)
+            assert lottery["sold_tickets"] == sum(table.ticket_counts().values())
+        for user_id, user in data["users"].items():
+            tickets = sum(l["tickets"].count(user_id) for l in lotteries.values())
+            assert user["balance"] >= 0, user_id
+            assert user["balance"] == initial - price * tickets, user_id
+            assert user["total_tickets"] == tickets, user_id
+            assert tickets == min(attempts_by_user.get(user_id, 0), per_user_affordable), user_id
+
+    print(json.dumps({
+        "purchases": args.purchases,
+        "bought": bought,
+        "rejected": args.purchases - bought,
+        "seconds": round(elapsed, 3),
+        "purchases_per_second": round(args.purchases / elapsed),
+        "locks_left": len(bot.locks)
+    }, ensure_ascii=False))
+    assert len(bot.locks) == 0
+    assert not store.check_aggregates()
+    print("✅ Балансы, журнал балансов и проданные билеты сходятся")
+
+# ========================
+# 🗜️ СВОРАЧИВАНИЕ ЖУРНАЛА
+# ========================
+
+async def compact(args):
+    """Операция, пришедшая во время записи, не обгоняет журнал при сворачивании.
+
+    Запись журнала искусственно замедлена. Пока сворачивание сбрасывает
+    первую операцию, приходит вторая; затем процесс «падает» без
+    финального сброса. Состояние с диска должно совпасть с памятью,
+    а балансы — с журналом балансов.
+    """
+    from ledger import Ledger
+    from storage import JournalBackend, StateStore
+
+    class SlowJournal(JournalBackend):
+        def write(self, payload):
+            time.sleep(args.delay)
+            super().write(payload)
+
+    paths = (os.path.join(args.workdir, "state.snap"), os.path.join(args.workdir, "journal.jsonl"))
+    ledger_path = os.path.join(args.workdir, "ledger.jsonl")
+    store = StateStore(SlowJournal(*paths), ledger=Ledger(ledger_path))
+    store.load()
+
+    def deposit(amount):
+        return store.commit({
+            "op": "deposit", "user_id": "1", "amount": amount,
+            "charge_id": f"compact-{store.data.get('seq', 0)}", "paid_at": "2024-01-01T00:00:00"
+        })
+
+    store.commit({
+        "op": "register", "user_id": "1", "username": "user1", "first_name": "User 1",
+        "registered_at": "2024-01-01T00:00:00"
+    })
+    deposit(150)
+    compacting = asyncio.create_task(store.compact())
+    await asyncio.sleep(args.delay / 2)
+    late = deposit(25)
+    await compacting
+
+    assert not store.pending and late.done(), "снимок обогнал журнал"
+    # «Падение»: ни stop(), ни финального сброса
+    store.backend.close()
+
+    restarted = StateStore(JournalBackend(*paths), ledger=Ledger(ledger_path))
+    reloaded = restarted.load()
+    assert reloaded["seq"] == store.data["seq"]
+    assert reloaded["users"] == store.data["users"]
+    mismatches = await restarted.reconcile_ledger()
+    restarted.backend.close()
+    print(json.dumps({
+        "seq": reloaded["seq"],
+        "balance": reloaded["users"]["1"]["balance"],
+        "ledger": restarted.ledger.balances().get("1", 0)
+    }, ensure_ascii=False))
+    assert not mismatches, mismatches
+    print("✅ Снимок не обгоняет журнал, балансы после падения сходятся с журналом балансов")
+
+# ========================
+# 🎲 РОЗЫГРЫШ
+# ========================
+
+async def draw(args):
+    """Розыгрыш по компактному индексу против копирования всех билетов"""
+    import lottery
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        users = max(1, size // 10)
+        owners = array.array('l', (rng.randrange(users) for _ in range(size)))
+        secret = lottery.new_draw_secret()
+
+        started = time.perf_counter()
+        positions = lottery.draw_positions(secret, "bench", size, args.prizes)
+        plain = time.perf_counter() - started
+
+        started = time.perf_counter()
+        unique = lottery.draw_positions(
+            secret, "bench", size, args.prizes,
+            owner=owners.__getitem__, user_count=users, one_prize_per_user=True
+        )
+        per_user = time.perf_counter() - started
+
+        assert positions == lottery.draw_positions(secret, "bench", size, args.prizes)
+        assert len({owners[p] for p in unique}) == len(unique)
+
+        result = {
+            "tickets": size,
+            "prizes": args.prizes,
+            "index_mb": round(owners.itemsize * len(owners) / 2 ** 20, 1),
+            "draw_ms": round(plain * 1000, 3),
+            "one_prize_per_user_ms": round(per_user * 1000, 3)
+        }
+
+        if size <= args.legacy_limit:
+            # Прежний способ: список словарей-билетов и random.sample по копии
+            tickets = [{"number": i, "user_id": str(owners[i])} for i in range(size)]
+            started = time.perf_counter()
+            all_tickets = [ticket for ticket in tickets]
+            random.sample(all_tickets, min(args.prizes, len(all_tickets)))
+            result["legacy_draw_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            del tickets, all_tickets
+
+        print(json.dumps(result))
+        del owners
+
+# ========================
+# 🎟️ ХРАНЕНИЕ БИЛЕТОВ
+# ========================
+
+def measure(build):
+    """(результат, байт памяти) для build()"""
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+async def tickets(args):
+    """Колонки TicketTable против словаря на каждый билет"""
+    import gzip
+    from storage import encode_state
+    from tickets import TicketTable
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        users = max(1, size // 10)
+        purchases = [
+            (str(1_000_000 + rng.randrange(users)), 1_000_000 + i, 1_700_000_000 + i)
+            for i in range(size)
+        ]
+
+        def legacy():
+            # Прежний формат: словарь на билет и номера еще раз в participants
+            tickets, participants = [], {}
+            for user_id, number, epoch in purchases:
+                tickets.append({
+                    "number": number,
+                    "user_id": user_id,
+                    "username": f"user{user_id}",
+                    "first_name": f"User {user_id}",
+                    "purchased_at": datetime.fromtimestamp(epoch).isoformat()
+                })
+                participants.setdefault(user_id, []).append(number)
+            return {"tickets": tickets, "participants": participants}
+
+        def columns():
+            table = TicketTable()
+            for user_id, number, epoch in purchases:
+                table.append(user_id, (number,), epoch)
+            return {"tickets": table}
+
+        old, old_memory = measure(legacy)
+        old_json = json.dumps(old, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        del old
+        new, new_memory = measure(columns)
+        new_json = json.dumps(new, separators=(',', ':'), default=encode_state).encode('utf-8')
+
+        started = time.perf_counter()
+        restored = TicketTable.from_json(json.loads(new_json)["tickets"])
+        load_ms = (time.perf_counter() - started) * 1000
+        assert restored.numbers == new["tickets"].numbers
+        assert restored.ticket_counts() == new["tickets"].ticket_counts()
+
+        print(json.dumps({
+            "tickets": size,
+            "legacy_memory_mb": round(old_memory / 2 ** 20, 1),
+            "columns_memory_mb": round(new_memory / 2 ** 20, 1),
+            "legacy_bytes_per_ticket": round(old_memory / size),
+            "columns_bytes_per_ticket": round(new_memory / size),
+            "legacy_json_mb": round(len(old_json) / 2 ** 20, 1),
+            "columns_json_mb": round(len(new_json) / 2 ** 20, 1),
+            "legacy_gzip_mb": round(len(gzip.compress(old_json, 6)) / 2 ** 20, 1),
+            "columns_gzip_mb": round(len(gzip.compress(new_json, 6)) / 2 ** 20, 1),
+            "columns_load_ms": round(load_ms, 1)
+        }))
+        del new, restored, old_json, new_json, purchases
+
+# ========================
+# 💽 СНИМОК СОСТОЯНИЯ
+# ========================
+
+def synthetic_state(rng, users, tickets, lotteries):
+    """Состояние с users пользователями и tickets билетами в lotteries розыгрышах"""
+    from tickets import TicketTable
+
+    data = {"seq": 1, "users": {}, "active_lotteries": {}, "ended_lotteries": {}}
+    user_ids = [str(1_000_000 + i) for i in range(users)]
+    for user_id in user_ids:
+        data["users"][user_id] = {
+            "balance": rng.randrange(1000), "total_spent": 0, "total_tickets": 0,
+            "username": f"user{user_id}", "first_name": f"User {user_id}",
+            "registered_at": "2024-01-01T00:00:00"
+        }
+    per_lottery = tickets // lotteries
+    for i in range(lotteries):
+        table = TicketTable()
+        for position in range(per_lottery):
+            table.append(rng.choice(user_ids), (1_000_000 + position,), 1_700_000_000 + position)
+        data["active_lotteries"][f"L{i}"] = {
+            "id": f"L{i}", "prize_count": 3, "ticket_price": 5, "duration_seconds": 86400,
+            "lottery_text": "bench", "created_at": "2024-01-01T00:00:00", "ends_at": "2099-01-01T00:00:00",
+            "sold_tickets": per_lottery, "is_active": True, "tickets": table
+        }
+    return data
+
+async def snapshot_bench(args):
+    """Сохранение и загрузка: JSON против бинарного снимка"""
+    import snapshot
+    from storage import encode_state, read_json_state
+
+    data = synthetic_state(random.Random(args.seed), args.users, args.tickets, args.lotteries)
+    per_lottery = args.tickets // args.lotteries
+
+    json_path = os.path.join(args.workdir, "state.json")
+    snap_path = os.path.join(args.workdir, "state.snap")
+
+    def save_json():
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=encode_state)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+
+    def save_snapshot():
+        snapshot.write(snap_path, snapshot.encode(data))
+
+    for name, save, load_state, path in (
+        ("json", save_json, lambda: read_json_state(json_path), json_path),
+        ("binary", save_snapshot, lambda: snapshot.load(snap_path), snap_path),
+    ):
+        started = time.perf_counter()
+        save()
+        save_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        loaded = load_state()
+        load_ms = (time.perf_counter() - started) * 1000
+        assert len(loaded["users"]) == args.users
+        assert sum(len(l["tickets"]) for l in loaded["active_lotteries"].values()) == per_lottery * args.lotteries
+        del loaded
+
+        gc.collect()
+        tracemalloc.start()
+        loaded = load_state()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del loaded
+
+        print(json.dumps({
+            "format": name,
+            "users": args.users,
+            "tickets": per_lottery * args.lotteries,
+            "size_mb": round(os.path.getsize(path) / 2 ** 20, 1),
+            "save_ms": round(save_ms),
+            "load_ms": round(load_ms),
+            "load_peak_mb": round(peak / 2 ** 20, 1)
+        }))
+
+# ========================
+# 🧭 СОСТОЯНИЯ ДИАЛОГОВ
+# ========================
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+async def fsm(args):
+    """get/set состояний: MemoryStorage против SqliteFSMStorage"""
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from fsm_storage import SqliteFSMStorage
+
+    path = os.path.join(args.workdir, "fsm_bench.db")
+    keys = [StorageKey(bot_id=1, chat_id=user_id, user_id=user_id) for user_id in range(args.users)]
+    states = ["AdminStates:waiting_for_prize_count", "AdminStates:waiting_for_ticket_price",
+              "AdminStates:waiting_for_duration", "AdminStates:waiting_for_lottery_text"]
+
+    for name, storage in (("memory", MemoryStorage()), ("sqlite", SqliteFSMStorage(path))):
+        set_times = []
+        get_times = []
+
+        async def dialog(key):
+            # Как мастер создания: состояние, данные, чтение на каждом шаге
+            for step in range(args.steps):
+                await asyncio.sleep(0)
+                started = time.perf_counter()
+                await storage.set_state(key, states[step % len(states)])
+                await storage.update_data(key, {f"field{step}": step})
+                set_times.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                await storage.get_state(key)
+                await storage.get_data(key)
+                get_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(dialog(key) for key in keys))
+        elapsed = time.perf_counter() - started
+        await storage.close()
+
+        result = {
+            "storage": name,
+            "users": args.users,
+            "steps_per_second": round(args.users * args.steps / elapsed),
+            "set_p50_us": round(percentile(set_times, 0.5) * 1e6, 1),
+            "set_p99_us": round(percentile(set_times, 0.99) * 1e6, 1),
+            "get_p50_us": round(percentile(get_times, 0.5) * 1e6, 1),
+            "get_p99_us": round(percentile(get_times, 0.99) * 1e6, 1)
+        }
+        if name == "sqlite":
+            reopened = SqliteFSMStorage(path)
+            assert len(reopened.records) == args.users
+            assert await reopened.get_state(keys[-1]) == states[(args.steps - 1) % len(states)]
+            await reopened.close()
+            result["file_mb"] = round(os.path.getsize(path) / 2 ** 20, 2)
+        print(json.dumps(result))
+
+# ========================
+# 🚦 НАГРУЗКА НА ДИСПЕТЧЕР
+# ========================
+
+def fake_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class FakeSession(BaseSession):
+        """Сессия бота без сети: запоминает вызовы и отвечает заглушками"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.next_message_id = 1
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] += 1
+            if name == "SendMessage":
+                self.next_message_id += 1
+                return Message(
+                    message_id=self.next_message_id,
+                    date=datetime.now(),
+                    chat=Chat(id=method.chat_id, type="private"),
+                    text=method.text
+                )
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            raise NotImplementedError
+
+        async def close(self):
+            pass
+
+    return FakeSession
+
+def install_fake_session(bot):
+    """Подменяем сессию бота, сохраняя ее middleware"""
+    session = fake_session_class()()
+    session.middleware = bot.bot.session.middleware
+    bot.bot.session = session
+    return session
+
+class UpdateFactory:
+    """Синтетические апдейты от имени пользователей"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+    def _update(self, **payload):
+        from aiogram.types import Update
+        self.update_id += 1
+        return Update.model_validate({"update_id": self.update_id, **payload}, context={"bot": self.bot})
+
+    def message(self, user_id, text):
+        return self._update(message={
+            "message_id": self.update_id, "date": 0, "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)
+        })
+
+    def pre_checkout(self, user_id, amount):
+        return self._update(pre_checkout_query={
+            "id": str(self.update_id), "from": self._user(user_id), "currency": "XTR",
+            "total_amount": amount, "invoice_payload": f"deposit:{amount}"
+        })
+
+    def payment(self, user_id, amount):
+        """Сообщение об успешной оплате звездами"""
+        return self._update(message={
+            "message_id": self.update_id, "date": 0,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+            "successful_payment": {
+                "currency": "XTR", "total_amount": amount, "invoice_payload": f"deposit:{amount}",
+                "telegram_payment_charge_id": f"charge-{self.update_id}", "provider_payment_charge_id": ""
+            }
+        })
+
+    def callback(self, user_id, data):
+        return self._update(callback_query={
+            "id": str(self.update_id), "chat_instance": str(user_id), "data": data,
+            "from": self._user(user_id),
+            "message": {
+                "message_id": self.update_id, "date": 0, "text": "…",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot"}
+            }
+        })
+
+class LoadScenario:
+    """Сценарий нагрузки, общий для load и shards.
+
+    Админ создает розыгрыши через мастер, пользователи регистрируются,
+    пополняют баланс звездами, смотрят розыгрыши, покупают билеты и
+    открывают «Мои билеты», затем админ завершает все розыгрыши.
+    feed(update) доставляет апдейт боту и ждет его обработки.
+    """
+
+    def __init__(self, make, admin, feed, rng, concurrency):
+        self.make = make
+        self.admin = admin
+        self.feed = feed
+        self.rng = rng
+        self.concurrency = concurrency
+        self.latencies = {}
+
+    async def send(self, kind, update):
+        started = time.perf_counter()
+        await self.feed(update)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    async def run_scripts(self, scripts):
+        """Скрипты пользователей идут параллельно, шаги одного — по очереди"""
+        scripts = iter(scripts)
+
+        async def worker():
+            for script in scripts:
+                for kind, update in script:
+                    await self.send(kind, update)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def create_lotteries(self, count):
+        make = self.make
+        await self.send("start", make.message(self.admin, "/start"))
+        for _ in range(count):
+            for text in ("🎪 Создать розыгрыш", "3", "5"):
+                await self.send("create", make.message(self.admin, text))
+            await self.send("create", make.callback(self.admin, "duration_1d"))
+            await self.send("create", make.message(self.admin, "Нагрузочный розыгрыш"))
+
+    def onboarding(self, user_id):
+        yield "start", self.make.message(user_id, "/start")
+        yield "deposit", self.make.pre_checkout(user_id, 100)
+        yield "deposit", self.make.payment(user_id, 100)
+
+    def session(self, user_id, lottery_ids):
+        make, rng = self.make, self.rng
+        lottery_id = rng.choice(lottery_ids)
+        yield "browse", make.message(user_id, "🎫 Купить билет")
+        yield "view", make.callback(user_id, f"view_lottery_{lottery_id}")
+        for _ in range(rng.choice((0, 1, 1, 2))):
+            count = rng.choice(("", "", "", "_5"))
+            yield "buy", make.callback(user_id, f"buy_ticket_{lottery_id}{count}")
+        yield "my_tickets", make.message(user_id, "📋 Мои билеты")
+        if rng.random() < 0.3:
+            yield "balance", make.message(user_id, "💰 Баланс")
+
+    async def run_users(self, user_ids, lottery_ids):
+        await self.run_scripts(self.onboarding(user_id) for user_id in user_ids)
+        await self.run_scripts(self.session(user_id, lottery_ids) for user_id in user_ids)
+
+    async def close_lotteries(self, lottery_ids):
+        await self.send("end", self.make.message(self.admin, "🏁 Завершить розыгрыш"))
+        for lottery_id in lottery_ids:
+            await self.send("end", self.make.callback(self.admin, f"end_lottery_{lottery_id}"))
+
+    def report(self, elapsed):
+        everything = [latency for samples in self.latencies.values() for latency in samples]
+        return {
+            "updates": len(everything),
+            "updates_per_second": round(len(everything) / elapsed),
+            "p50_ms": round(percentile(everything, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(everything, 0.99) * 1000, 3),
+            "by_kind": {
+                kind: {
+                    "count": len(samples),
+                    "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+                    "p99_ms": round(percentile(samples, 0.99) * 1000, 3)
+                }
+                for kind, samples in self.latencies.items()
+            }
+        }
+
+async def load_users(args):
+    """Один прогон: args.users — одно число"""
+    os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000")
+    os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000")
+    bot = load_bot(args.workdir)
+    session = install_fake_session(bot)
+    dp = bot.dp
+    scenario = LoadScenario(
+        UpdateFactory(bot.bot), bot.MAIN_ADMIN_ID, lambda update: dp.feed_update(bot.bot, update),
+        random.Random(args.seed), args.concurrency
+    )
+
+    await dp.emit_startup(bot=bot.bot)
+    await scenario.create_lotteries(args.lotteries)
+    lottery_ids = list(bot.store.data["active_lotteries"])
+
+    started = time.perf_counter()
+    await scenario.run_users(range(100_000, 100_000 + args.users), lottery_ids)
+    await scenario.close_lotteries(lottery_ids)
+    elapsed = time.perf_counter() - started
+
+    assert not await bot.store.reconcile_ledger()
+    await dp.emit_shutdown(bot=bot.bot)
+    assert not bot.store.data["active_lotteries"]
+    assert not bot.store.check_aggregates()
+
+    report = scenario.report(elapsed)
+    print(json.dumps({
+        "users": args.users,
+        **{k: v for k, v in report.items() if k != "by_kind"},
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tickets_sold": bot.store.aggregates.tickets_sold,
+        "by_kind": report["by_kind"],
+        "api_calls": dict(session.calls)
+    }, ensure_ascii=False))
+
+async def load(args):
+    """Смесь реального трафика через dp.feed_update на фейковой сессии.
+
+    Каждый размер запускается в отдельном процессе, чтобы пик RSS
+    относился только к нему.
+    """
+    if len(args.users) == 1:
+        args.users = args.users[0]
+        await load_users(args)
+        return
+    for users in args.users:
+        workdir = os.path.join(args.workdir, f"load_{users}")
+        os.makedirs(workdir)
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), "--workdir", workdir, "--seed", str(args.seed),
+            "load", "--users", str(users), "--lotteries", str(args.lotteries),
+            "--concurrency", str(args.concurrency)
+        ], check=True)
+
+# ========================
+# 🧩 ШАРДИРОВАННЫЙ РЕЖИМ
+# ========================
+
+def replica_summary(store):
+    """Отпечаток состояния, который должен совпасть у владельца и реплик"""
+    balances = {
+        user_id: (user["balance"], user["total_tickets"])
+        for user_id, user in store.data["users"].items()
+    }
+    return {
+        "balances": hashlib.sha256(json.dumps(balances, sort_keys=True).encode()).hexdigest(),
+        "aggregates": store.aggregates.as_dict()
+    }
+
+async def shard_worker(args):
+    """Воркер для shards: фейковая сессия и отпечаток реплики при выходе"""
+    bot = load_bot(args.workdir)
+    install_fake_session(bot)
+    index = int(os.environ["SHARD_INDEX"])
+    await bot.run_shard_worker(index)
+    with open(f"replica.{index}.json", "w") as f:
+        json.dump(replica_summary(bot.store), f)
+
+async def shards_run(args):
+    """Один прогон: args.workers — одно число"""
+    os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000")
+    os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000")
+    bot = load_bot(args.workdir)
+    session = install_fake_session(bot)
+    store = bot.store
+
+    await bot.dp.emit_startup(bot=bot.bot)
+
+    user_ids = range(100_000, 100_000 + args.users)
+
+    owner = bot.StateOwner(
+        store, bot.commands, bot.SHARD_SOCKET, args.workers,
+        [sys.executable, os.path.abspath(__file__), "--workdir", args.workdir, "shard-worker"],
+        errors=(bot.PurchaseError,)
+    )
+    started = time.perf_counter()
+    await owner.start()
+    startup = time.perf_counter() - started
+
+    # Как в long polling владельца: апдейт уходит воркеру словарем
+    scenario = LoadScenario(
+        UpdateFactory(bot.bot), bot.MAIN_ADMIN_ID,
+        lambda update: owner.route(update.model_dump(mode="json", by_alias=True, exclude_none=True)),
+        random.Random(args.seed), args.concurrency
+    )
+
+    # Админ создает розыгрыши через мастер в своем воркере
+    await scenario.create_lotteries(args.lotteries)
+    lottery_ids = list(store.data["active_lotteries"])
+    assert len(lottery_ids) == args.lotteries
+
+    started = time.perf_counter()
+    await scenario.run_users(user_ids, lottery_ids)
+    await scenario.close_lotteries(lottery_ids)
+    elapsed = time.perf_counter() - started
+
+    await owner.stop()
+    assert not await store.reconcile_ledger()
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    assert not store.data["active_lotteries"]
+    assert not store.check_aggregates()
+    for lottery_id in lottery_ids:
+        lottery = await store.full_lottery(lottery_id)
+        assert lottery["sold_tickets"] == len(lottery["tickets"]) == len(set(lottery["tickets"].numbers))
+    for user_id, user in store.data["users"].items():
+        assert user["balance"] >= 0 and user["balance"] + user["total_spent"] == (100 if int(user_id) in user_ids else 0)
+    # Реплики получили те же операции, что и владелец
+    expected = replica_summary(store)
+    for index in range(args.workers):
+        with open(f"replica.{index}.json") as f:
+            assert json.load(f) == expected, index
+
+    report = scenario.report(elapsed)
+    print(json.dumps({
+        "workers": args.workers,
+        "users": args.users,
+        **{k: v for k, v in report.items() if k != "by_kind"},
+        "startup_ms": round(startup * 1000),
+        "routed": owner.routed,
+        "restarts": owner.restarts,
+        "tickets_sold": store.aggregates.tickets_sold,
+        "by_kind": report["by_kind"],
+        "owner_api_calls": dict(session.calls)
+    }, ensure_ascii=False))
+    print("✅ Состояние владельца и реплик сходится")
+
+async def shards(args):
+    """Владелец состояния здесь, воркеры — отдельные процессы на фейковой сессии.
+
+    Каждое число воркеров запускается в отдельном процессе и папке.
+    """
+    if len(args.workers) == 1:
+        args.workers = args.workers[0]
+        await shards_run(args)
+        return
+    for workers in args.workers:
+        workdir = os.path.join(args.workdir, f"shards_{workers}")
+        os.makedirs(workdir)
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), "--workdir", workdir, "--seed", str(args.seed),
+            "shards", "--workers", str(workers), "--users", str(args.users),
+            "--lotteries", str(args.lotteries), "--concurrency", str(args.concurrency)
+        ], check=True)
+
+# ========================
+# 🚀 ЗАПУСК
+# ========================
+
+async def startup_run(args):
+    """Один запуск бота в чистом процессе: фазы и два первых апдейта"""
+    bot = load_bot(args.workdir)
+    install_fake_session(bot)
+    if args.cold:
+        # Как до прогрева: цепочки билетов и меню строятся на первом запросе
+        bot.warm_state = lambda: None
+    make = UpdateFactory(bot.bot)
+    user_id = 1_000_000
+
+    await bot.dp.emit_startup(bot=bot.bot)
+    updates = []
+    for _ in range(2):
+        started = time.perf_counter()
+        await bot.dp.feed_update(bot.bot, make.message(user_id, "📋 Мои билеты"))
+        updates.append(time.perf_counter() - started)
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    print(json.dumps({
+        "mode": "cold" if args.cold else "warm",
+        **{f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in bot.startup.phases.items()},
+        "second_update_ms": round(updates[1] * 1000, 1),
+        "web_imported": sorted(name for name in ("fastapi", "uvicorn", "starlette") if name in sys.modules)
+    }, ensure_ascii=False))
+
+async def startup(args):
+    """Время запуска в режиме polling: без прогрева и с прогревом"""
+    import snapshot
+
+    data = synthetic_state(random.Random(args.seed), args.users, args.tickets, args.lotteries)
+    snapshot.write(os.path.join(args.workdir, "lottery_state.snap"), snapshot.encode(data))
+    del data
+    for cold in (True, False):
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), "--workdir", args.workdir,
+            "startup-run", *(["--cold"] if cold else [])
+        ], check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", help="папка для файлов данных (по умолчанию временная)")
+    parser.add_argument("--seed", type=int, default=1)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("stress", help="одновременные покупки и проверка балансов")
+    cmd.add_argument("--users", type=int, default=1000)
+    cmd.add_argument("--lotteries", type=int, default=3)
+    cmd.add_argument("--purchases", type=int, default=20000)
+    cmd.set_defaults(func=stress)
+
+    cmd = commands.add_parser("compact", help="операция во время записи и сворачивание журнала")
+    cmd.add_argument("--delay", type=float, default=0.2, help="длительность одной записи журнала, с")
+    cmd.set_defaults(func=compact)
+
+    cmd = commands.add_parser("draw", help="скорость розыгрыша на больших объемах")
+    cmd.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    cmd.add_argument("--prizes", type=int, default=100)
+    cmd.add_argument("--legacy-limit", type=int, default=1_000_000,
+                     help="до какого размера сравнивать с копированием билетов")
+    cmd.set_defaults(func=draw)
+
+    cmd = commands.add_parser("tickets", help="память и размер файла: колонки против словарей")
+    cmd.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    cmd.set_defaults(func=tickets)
+
+    cmd = commands.add_parser("snapshot", help="сохранение и загрузка снимка: JSON против бинарного")
+    cmd.add_argument("--users", type=int, default=100_000)
+    cmd.add_argument("--tickets", type=int, default=1_000_000)
+    cmd.add_argument("--lotteries", type=int, default=10)
+    cmd.set_defaults(func=snapshot_bench)
+
+    cmd = commands.add_parser("fsm", help="задержки хранилища состояний диалогов")
+    cmd.add_argument("--users", type=int, default=10000)
+    cmd.add_argument("--steps", type=int, default=5)
+    cmd.set_defaults(func=fsm)
+
+    cmd = commands.add_parser("load", help="пропускная способность диспетчера на синтетических апдейтах")
+    cmd.add_argument("--users", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    cmd.add_argument("--lotteries", type=int, default=20)
+    cmd.add_argument("--concurrency", type=int, default=100,
+                     help="сколько пользователей действуют одновременно")
+    cmd.set_defaults(func=load)
+
+    cmd = commands.add_parser("shards", help="шардированный режим: владелец состояния и воркеры")
+    cmd.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    cmd.add_argument("--users", type=int, default=10_000)
+    cmd.add_argument("--lotteries", type=int, default=20)
+    cmd.add_argument("--concurrency", type=int, default=100,
+                     help="сколько пользователей действуют одновременно")
+    cmd.set_defaults(func=shards)
+
+    cmd = commands.add_parser("startup", help="время запуска: импорт, загрузка, прогрев, первый апдейт")
+    cmd.add_argument("--users", type=int, default=100_000)
+    cmd.add_argument("--tickets", type=int, default=1_000_000)
+    cmd.add_argument("--lotteries", type=int, default=10)
+    cmd.set_defaults(func=startup)
+
+    cmd = commands.add_parser("startup-run", help=argparse.SUPPRESS)
+    cmd.add_argument("--cold", action="store_true")
+    cmd.set_defaults(func=startup_run)
+
+    cmd = commands.add_parser("shard-worker", help=argparse.SUPPRESS)
+    cmd.set_defaults(func=shard_worker)
+
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        args.workdir = args.workdir or tmp
+        asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    main()
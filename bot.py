@@ -1,24 +1,47 @@
+import time
+# Отсюда считается время запуска
+IMPORT_STARTED = time.perf_counter()
+
 import asyncio
-import random
+import hashlib
+import heapq
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery
 from aiogram.enums import ParseMode, ChatType
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-import json
 import os
 import uuid
 import re
-from fastapi import FastAPI
-import uvicorn
+import secrets
+import signal
+import sys
+from collections import deque
 import threading
 
+from lottery import (
+    FIRST_TICKET_DIGITS, allocate_tickets, draw_commitment, draw_lottery,
+    new_draw_secret, new_ticket_key, verify_draw
+)
+from fsm_storage import SqliteFSMStorage
+from ledger import Ledger
+from metrics import (
+    FirstUpdateMiddleware, Gauge, HandlerMetricsMiddleware, StartupTimer, TelegramRequestMetrics,
+    UpdateMetricsMiddleware, render as render_metrics
+)
+from outbox import Outbox, PurchaseDigest
+from sharding import ShardClient, StateCommands, StateOwner
+from storage import KeyedLocks, LotteryArchive, StateStore, create_backend, lottery_users
+from throttling import ThrottlingMiddleware, parse_limit, parse_limits
+
 # Загружаем настройки
 from dotenv import load_dotenv
 load_dotenv()
@@ -37,14 +60,131 @@ logger = logging.getLogger(__name__)
 
 # 🚀 Инициализация бота
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
-dp.include_router(router)
 
 # 📁 Файлы данных
 DATA_FILE = "lottery_data.json"
 CHANNELS_FILE = "channels_data.json"
+SQLITE_FILE = "lottery_data.db"
+JOURNAL_FILE = "lottery_journal.jsonl"
+SNAPSHOT_FILE = "lottery_state.snap"
+OUTBOX_FILE = "outbox.json"
+LEDGER_FILE = "ledger.jsonl"
+# У каждого воркера шардированного режима свои диалоги
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+FSM_FILE = f"fsm_states.{SHARD_INDEX}.db" if SHARD_INDEX else "fsm_states.db"
+ARCHIVE_DIR = "archive"
+
+# 🧭 Состояния диалогов: sqlite переживает перезапуск, memory — нет.
+# Срок жизни в секундах; ввод количества билетов бросают чаще мастера
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_BUYER_STATE_TTL = int(os.getenv("FSM_BUYER_STATE_TTL", "900"))
+
+if FSM_STORAGE == "sqlite":
+    storage = SqliteFSMStorage(
+        FSM_FILE,
+        FSM_STATE_TTL,
+        {"BuyerStates:waiting_for_ticket_count": FSM_BUYER_STATE_TTL}
+    )
+else:
+    storage = MemoryStorage()
+dp = Dispatcher(storage=storage)
+# Платежи — в своем роутере перед основным: их не ограничивает частота
+# и не перехватывают обработчики состояний диалогов
+payments_router = Router()
+router = Router()
+dp.include_router(payments_router)
+dp.include_router(router)
+
+# 🚦 Ограничение частоты: "нажатий в секунду/запас" по умолчанию и
+# для отдельных обработчиков, например "buy_ticket_process=1/3"
+THROTTLE_DEFAULT = parse_limit(os.getenv("THROTTLE_DEFAULT", "3/10"))
+THROTTLE_LIMITS = parse_limits(os.getenv(
+    "THROTTLE_LIMITS", "buy_ticket_process=1/3,view_lottery_details=2/5,buy_custom_count=1/3"
+))
+THROTTLE_MAX_BUCKETS = int(os.getenv("THROTTLE_MAX_BUCKETS", "100000"))
+
+throttling = ThrottlingMiddleware(THROTTLE_DEFAULT, THROTTLE_LIMITS, THROTTLE_MAX_BUCKETS, exempt={MAIN_ADMIN_ID})
+router.message.middleware(throttling)
+router.callback_query.middleware(throttling)
+
+# 📈 Метрики: апдейты в работе, время обработчиков и запросов к Bot API,
+# фазы запуска до первого апдейта
+startup = StartupTimer(IMPORT_STARTED)
+dp.update.outer_middleware(FirstUpdateMiddleware(startup, logger.info))
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+payments_router.message.middleware(HandlerMetricsMiddleware())
+payments_router.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(TelegramRequestMetrics())
+
+# 💾 Хранилище и фоновая запись состояния
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "journal")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+STATE_FLUSH_THRESHOLD = int(os.getenv("STATE_FLUSH_THRESHOLD", "100"))
+
+store = StateStore(
+    create_backend(STORAGE_BACKEND, DATA_FILE, SQLITE_FILE, JOURNAL_FILE, SNAPSHOT_FILE),
+    STATE_FLUSH_INTERVAL,
+    STATE_FLUSH_THRESHOLD,
+    archive=LotteryArchive(ARCHIVE_DIR),
+    ledger=Ledger(LEDGER_FILE)
+)
+locks = KeyedLocks()
+# Все изменения состояния — команды: в шардированном режиме воркеры
+# отправляют их процессу-владельцу
+commands = StateCommands()
+
+# 🎫 Покупка нескольких билетов
+TICKET_QUANTITIES = (1, 5, 10)
+MAX_TICKETS_PER_PURCHASE = int(os.getenv("MAX_TICKETS_PER_PURCHASE", "1000"))
+
+# 🗂️ Списки розыгрышей: кнопок на странице
+LOTTERIES_PAGE_SIZE = 8
+
+# 📋 «Мои билеты»: розыгрышей на странице и номеров на розыгрыш
+MY_TICKETS_PAGE_SIZE = 5
+MY_TICKETS_SHOWN_NUMBERS = 10
+
+# 🎲 Один приз в одни руки для новых розыгрышей
+ONE_PRIZE_PER_USER = os.getenv("ONE_PRIZE_PER_USER", "0") == "1"
+
+# 📮 Уведомления: лимиты Telegram и рассылка итогов всем участникам
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+NOTIFY_PARTICIPANTS = os.getenv("NOTIFY_PARTICIPANTS", "0") == "1"
+
+outbox = Outbox(bot, OUTBOX_FILE, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE)
+
+# 🧾 Сводки покупок для админа: окно в секундах и порог мгновенного оповещения
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "300"))
+ADMIN_ALERT_AMOUNT = int(os.getenv("ADMIN_ALERT_AMOUNT", "500"))
+
+purchase_digest = PurchaseDigest(outbox, MAIN_ADMIN_ID, ADMIN_DIGEST_INTERVAL, ADMIN_ALERT_AMOUNT)
+
+# ⭐ Пополнение звездами Telegram: суммы на кнопках, предел одного
+# пополнения и как часто сверять балансы с журналом (секунды)
+DEPOSIT_AMOUNTS = [int(amount) for amount in os.getenv("DEPOSIT_AMOUNTS", "50,100,250,500").split(",")]
+DEPOSIT_MAX = int(os.getenv("DEPOSIT_MAX", "10000"))
+LEDGER_RECONCILE_INTERVAL = float(os.getenv("LEDGER_RECONCILE_INTERVAL", "3600"))
+
+# 🪝 Webhook: если задан внешний адрес, апдейты принимает FastAPI
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram принимает в secret_token только A-Z, a-z, 0-9, _ и - (до 256
+# символов), а значение, которое генерирует Render, бывает с + / =.
+# Неподходящий секрет превращаем в его sha256 в hex
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    WEBHOOK_SECRET = hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+
+# 🧩 Шардированный режим: SHARD_WORKERS > 0 — процесс-владелец состояния
+# и столько воркеров, апдейты делятся между ними по user_id
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_SOCKET = os.getenv("SHARD_SOCKET", "lottery_shards.sock")
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
 
 # 🔧 Проверка токена
 if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
@@ -54,29 +194,210 @@ if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
 # 📊 ФУНКЦИИ ДЛЯ ДАННЫХ
 # ========================
 
-def load_data():
-    """Загружаем данные о розыгрышах"""
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return {"active_lotteries": {}, "ended_lotteries": {}, "users": {}}
+async def register_user(user):
+    """Регистрируем пользователя, если его еще нет"""
+    user_id = str(user.id)
+    if user_id not in store.data["users"]:
+        await register(user_id=user_id, username=user.username, first_name=user.first_name)
+    return store.data["users"][user_id]
+
+@commands
+async def register(user_id, username, first_name):
+    if user_id not in store.data["users"]:
+        store.commit({
+            "op": "register",
+            "user_id": user_id,
+            "username": username,
+            "first_name": first_name,
+            "registered_at": datetime.now().isoformat()
+        })
+
+def lottery_is_open(lottery):
+    """Розыгрыш еще принимает покупки"""
+    return datetime.fromisoformat(lottery["ends_at"]) > datetime.now()
+
+class PurchaseError(Exception):
+    """Покупка невозможна; текст ошибки показываем пользователю"""
+
+async def purchase_tickets(lottery_id, user, count=1):
+    """Покупаем count билетов: (розыгрыш, пользователь, номера билетов)"""
+    ticket_numbers = await purchase(
+        lottery_id=lottery_id,
+        user_id=str(user.id),
+        username=user.username,
+        first_name=user.first_name,
+        count=count
+    )
+    return store.find_lottery(lottery_id), store.data["users"][str(user.id)], ticket_numbers
+
+@commands
+async def purchase(lottery_id, user_id, username, first_name, count):
+    """Покупка под блокировками розыгрыша и пользователя.
+
+    Проверка баланса и списание идут под одной блокировкой, поэтому
+    двойное нажатие не потратит баланс дважды, а покупки в разных
+    розыгрышах не ждут друг друга. Все билеты пишутся одной операцией.
+    """
+    if not 1 <= count <= MAX_TICKETS_PER_PURCHASE:
+        raise PurchaseError(f"❌ Можно купить от 1 до {MAX_TICKETS_PER_PURCHASE} билетов!")
+    
+    async with locks.hold(f"lottery:{lottery_id}", f"user:{user_id}"):
+        lottery = store.data["active_lotteries"].get(lottery_id)
+        if lottery is None:
+            raise PurchaseError("❌ Розыгрыш не найден!")
+        if not lottery_is_open(lottery):
+            raise PurchaseError("⏰ Розыгрыш уже завершается!")
+        
+        await register(user_id=user_id, username=username, first_name=first_name)
+        if store.data["users"][user_id]["balance"] < lottery["ticket_price"] * count:
+            raise PurchaseError("❌ Не хватает звезд!")
+        
+        ticket_numbers = allocate_tickets(lottery, count)
+        await store.commit({
+            "op": "purchase",
+            "lottery_id": lottery_id,
+            "user_id": user_id,
+            "price": lottery["ticket_price"],
+            "tickets": ticket_numbers,
+            "purchased_at": datetime.now().isoformat()
+        })
+    
+    # Уведомление админу
+    notify_admin_purchase(user_id, username, lottery, count)
+    return ticket_numbers
+
+def purchase_text(lottery, user_data, ticket_numbers):
+    """Сообщение покупателю"""
+    count = len(ticket_numbers)
+    if count == 1:
+        return (
+            f"🎉 <b>БИЛЕТ КУПЛЕН!</b>\n\n"
+            f"🎫 Номер билета: <code>{ticket_numbers[0]}</code>\n"
+            f"💰 Стоимость: {lottery['ticket_price']} звезд\n"
+            f"⭐ Остаток: {user_data['balance']} звезд\n\n"
+            f"🍀 Удачи в розыгрыше!"
+        )
+    
+    shown = ", ".join(f"<code>{number}</code>" for number in ticket_numbers[:20])
+    if count > 20:
+        shown += f" и еще {count - 20}"
+    return (
+        f"🎉 <b>КУПЛЕНО БИЛЕТОВ: {count}</b>\n\n"
+        f"🎫 Номера: {shown}\n"
+        f"💰 Стоимость: {lottery['ticket_price'] * count} звезд\n"
+        f"⭐ Остаток: {user_data['balance']} звезд\n\n"
+        f"🍀 Удачи в розыгрыше!"
+    )
+
+def notify_admin_purchase(user_id, username, lottery, count):
+    """Покупка попадет в сводку админу; крупная — сразу отдельным сообщением"""
+    if not MAIN_ADMIN_ID:
+        return
+    purchase_digest.add(
+        lottery["id"],
+        f"@{username}" if username else f"id{user_id}",
+        count,
+        lottery["ticket_price"] * count
+    )
+
+class RenderCache:
+    """Кэш отрисованных меню (LRU).
+
+    В ключ входят версии данных, от которых зависит отрисовка, поэтому
+    устаревшие записи просто перестают запрашиваться и вытесняются.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-def save_data(data):
-    """Сохраняем данные"""
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def get(self, key, render):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        value = self.items[key] = render()
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return value
+
+render_cache = RenderCache()
+
+LOTTERY_SORTS = {
+    "soon": ("⏰ Скоро конец", lambda lottery: lottery["ends_at"]),
+    "popular": ("🔥 Популярные", lambda lottery: -lottery["sold_tickets"]),
+}
+
+def lottery_picker(menu, sort, page):
+    """Страница списка активных розыгрышей: (клавиатура, всего розыгрышей).
+
+    menu — "buy" (покупка) или "end" (завершение). Кэш сбрасывается при
+    создании и завершении розыгрышей, а для списков, где видны продажи
+    (популярные, меню завершения), — еще и при покупках.
+    """
+    if sort not in LOTTERY_SORTS:
+        sort = "soon"
+    depends_on_sales = sort == "popular" or menu == "end"
+    version = (store.catalog_version, store.sales_version if depends_on_sales else None)
+    return render_cache.get(("picker", menu, sort, page, version), lambda: _render_lottery_picker(menu, sort, page))
+
+def _render_lottery_picker(menu, sort, page):
+    lotteries = [
+        lottery for lottery in store.data["active_lotteries"].values()
+        if menu == "end" or lottery_is_open(lottery)
+    ]
+    if not lotteries:
+        return None, 0
+    
+    lotteries.sort(key=LOTTERY_SORTS[sort][1])
+    pages = (len(lotteries) - 1) // LOTTERIES_PAGE_SIZE + 1
+    page = max(0, min(page, pages - 1))
+    
+    builder = InlineKeyboardBuilder()
+    for lottery in lotteries[page * LOTTERIES_PAGE_SIZE:(page + 1) * LOTTERIES_PAGE_SIZE]:
+        if menu == "buy":
+            ends_date = datetime.fromisoformat(lottery["ends_at"]).strftime('%d.%m')
+            builder.row(
+                types.InlineKeyboardButton(
+                    text=f"🎪 {lottery['prize_count']} призов • {lottery['ticket_price']}⭐ • до {ends_date}",
+                    callback_data=f"view_lottery_{lottery['id']}"
+                )
+            )
+        else:
+            ends_date = datetime.fromisoformat(lottery["ends_at"]).strftime('%d.%m %H:%M')
+            builder.row(
+                types.InlineKeyboardButton(
+                    text=f"🎪 #{lottery['id']} - {lottery['sold_tickets']} билетов - до {ends_date}",
+                    callback_data=f"end_lottery_{lottery['id']}"
+                )
+            )
+    
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"{menu}menu_{sort}_{page - 1}"))
+    if pages > 1:
+        navigation.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton(text="➡️", callback_data=f"{menu}menu_{sort}_{page + 1}"))
+    if navigation:
+        builder.row(*navigation)
+    
+    builder.row(*(
+        types.InlineKeyboardButton(
+            text=("• " if key == sort else "") + title,
+            callback_data=f"{menu}menu_{key}_0"
+        )
+        for key, (title, _) in LOTTERY_SORTS.items()
+    ))
+    return builder.as_markup(), len(lotteries)
 
 def generate_lottery_id():
     """Генерируем ID для розыгрыша"""
     return str(uuid.uuid4())[:8]
 
-def generate_ticket_number():
-    """Генерируем номер билета"""
-    return random.randint(100000, 999999)
-
 # ========================
 # 🎭 СОСТОЯНИЯ ДЛЯ АДМИНА
 # ========================
@@ -87,6 +408,15 @@ class AdminStates(StatesGroup):
     waiting_for_duration = State()
     waiting_for_lottery_text = State()
 
+class BuyerStates(StatesGroup):
+    waiting_for_ticket_count = State()
+
+# Кнопки главного меню: нажатие во время ввода числа билетов выходит из ввода
+MENU_BUTTONS = {
+    "🎫 Купить билет", "💰 Баланс", "📋 Мои билеты",
+    "🎪 Создать розыгрыш", "🏁 Завершить розыгрыш", "📊 Статистика"
+}
+
 # ========================
 # 🎬 КОМАНДА СТАРТ
 # ========================
@@ -94,21 +424,9 @@ class AdminStates(StatesGroup):
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     """Команда старт"""
-    user_id = str(message.from_user.id)
-    data = load_data()
-    
-    if user_id not in data["users"]:
-        data["users"][user_id] = {
-            "balance": 0,
-            "total_spent": 0,
-            "total_tickets": 0,
-            "username": message.from_user.username,
-            "first_name": message.from_user.first_name,
-            "registered_at": datetime.now().isoformat()
-        }
-        save_data(data)
+    await register_user(message.from_user)
     
-    if int(user_id) == MAIN_ADMIN_ID:
+    if message.from_user.id == MAIN_ADMIN_ID:
         keyboard = types.ReplyKeyboardMarkup(
             keyboard=[
                 [types.KeyboardButton(text="🎪 Создать розыгрыш")],
@@ -215,7 +533,7 @@ async def process_duration_selection(callback: CallbackQuery, state: FSMContext)
     
     if duration_type in duration_map:
         duration = duration_map[duration_type]
-        await state.update_data(duration_obj=duration)
+        await state.update_data(duration_seconds=int(duration.total_seconds()))
         
         await callback.message.answer(
             "📝 <b>Шаг 4 из 4</b>\n"
@@ -266,7 +584,7 @@ async def process_duration_input(message: Message, state: FSMContext):
             await message.answer("❌ Минимальная длительность - 1 минута!")
             return
         
-        await state.update_data(duration_obj=duration)
+        await state.update_data(duration_seconds=int(duration.total_seconds()))
         
         await message.answer(
             "📝 <b>Шаг 4 из 4</b>\n"
@@ -278,6 +596,11 @@ async def process_duration_input(message: Message, state: FSMContext):
     except:
         await message.answer("❌ Не могу распознать время!")
 
+@commands
+async def create_lottery(lottery):
+    await store.commit({"op": "create_lottery", "lottery": lottery})
+    expiry.schedule(lottery["id"], lottery["ends_at"])
+
 @router.message(AdminStates.waiting_for_lottery_text)
 async def process_lottery_text(message: Message, state: FSMContext):
     lottery_text = message.text.strip()
@@ -289,10 +612,11 @@ async def process_lottery_text(message: Message, state: FSMContext):
     data = await state.get_data()
     prize_count = data['prize_count']
     ticket_price = data['ticket_price']
-    duration = data['duration_obj']
+    duration = timedelta(seconds=data['duration_seconds'])
     
     lottery_id = generate_lottery_id()
     end_date = datetime.now() + duration
+    draw_secret = new_draw_secret()
     
     lottery_data = {
         "id": lottery_id,
@@ -303,14 +627,15 @@ async def process_lottery_text(message: Message, state: FSMContext):
         "created_at": datetime.now().isoformat(),
         "ends_at": end_date.isoformat(),
         "sold_tickets": 0,
-        "participants": {},
-        "tickets": [],
-        "is_active": True
+        "is_active": True,
+        "ticket_key": new_ticket_key(),
+        "ticket_digits": FIRST_TICKET_DIGITS,
+        "draw_secret": draw_secret,
+        "draw_commitment": draw_commitment(draw_secret),
+        "one_prize_per_user": ONE_PRIZE_PER_USER
     }
     
-    data_storage = load_data()
-    data_storage["active_lotteries"][lottery_id] = lottery_data
-    save_data(data_storage)
+    await create_lottery(lottery=lottery_data)
     
     ends_date = end_date.strftime('%d.%m.%Y в %H:%M')
     
@@ -319,7 +644,8 @@ async def process_lottery_text(message: Message, state: FSMContext):
         f"🎯 <b>Призовых мест:</b> {prize_count}\n"
         f"💰 <b>Цена билета:</b> {ticket_price} звезд\n"
         f"⏰ <b>Завершится:</b> {ends_date}\n"
-        f"🆔 <b>ID:</b> <code>{lottery_id}</code>\n\n"
+        f"🆔 <b>ID:</b> <code>{lottery_id}</code>\n"
+        f"🔐 <b>Хеш сида:</b> <code>{lottery_data['draw_commitment']}</code>\n\n"
         f"🎉 <b>Розыгрыш запущен!</b>"
     )
     
@@ -330,46 +656,50 @@ async def process_lottery_text(message: Message, state: FSMContext):
 # 🎫 ПОКУПКА БИЛЕТОВ
 # ========================
 
-@router.message(F.text == "🎫 Купить билет")
-async def buy_ticket_menu(message: Message):
-    data = load_data()
-    
-    if not data["active_lotteries"]:
-        await message.answer("📭 Сейчас нет активных розыгрышей")
-        return
-    
-    user_id = str(message.from_user.id)
+def buy_menu_text(user_id):
+    data = store.data
     user_balance = data["users"][user_id]["balance"] if user_id in data["users"] else 0
-    
-    builder = InlineKeyboardBuilder()
-    for lottery_id, lottery in data["active_lotteries"].items():
-        ends_date = datetime.fromisoformat(lottery["ends_at"]).strftime('%d.%m')
-        builder.row(
-            types.InlineKeyboardButton(
-                text=f"🎪 {lottery['prize_count']} призов • {lottery['ticket_price']}⭐ • до {ends_date}",
-                callback_data=f"view_lottery_{lottery_id}"
-            )
-        )
-    
-    await message.answer(
+    return (
         f"🎫 <b>Выбери розыгрыш</b>\n"
-        f"⭐ Баланс: {user_balance} звезд",
-        reply_markup=builder.as_markup()
+        f"⭐ Баланс: {user_balance} звезд"
     )
 
-@router.callback_query(F.data.startswith("view_lottery_"))
-async def view_lottery_details(callback: CallbackQuery):
-    lottery_id = callback.data.replace("view_lottery_", "")
-    data = load_data()
+@router.message(F.text == "🎫 Купить билет")
+async def buy_ticket_menu(message: Message):
+    keyboard, total = lottery_picker("buy", "soon", 0)
     
-    if lottery_id not in data["active_lotteries"]:
-        await callback.answer("❌ Розыгрыш не найден!")
+    if not total:
+        await message.answer("📭 Сейчас нет активных розыгрышей")
         return
     
-    lottery = data["active_lotteries"][lottery_id]
-    user_id = str(callback.from_user.id)
-    user_balance = data["users"][user_id]["balance"] if user_id in data["users"] else 0
+    await message.answer(buy_menu_text(str(message.from_user.id)), reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith("buymenu_"))
+async def buy_ticket_menu_page(callback: CallbackQuery):
+    _, sort, page = callback.data.split("_")
+    keyboard, total = lottery_picker("buy", sort, int(page))
     
+    if not total:
+        await callback.message.edit_text("📭 Сейчас нет активных розыгрышей")
+    else:
+        await callback.message.edit_text(buy_menu_text(str(callback.from_user.id)), reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(F.data == "noop")
+async def noop_callback(callback: CallbackQuery):
+    await callback.answer()
+
+def lottery_card(lottery_id):
+    """Общая для всех часть карточки розыгрыша: текст и кнопки.
+
+    Кэшируется по версии розыгрыша, которая меняется при каждой покупке,
+    так что даты, счетчики и кнопки не пересобираются на каждый просмотр.
+    """
+    version = store.lottery_versions.get(lottery_id, 0)
+    return render_cache.get(("card", lottery_id, version), lambda: _render_lottery_card(lottery_id))
+
+def _render_lottery_card(lottery_id):
+    lottery = store.data["active_lotteries"][lottery_id]
     ends_date = datetime.fromisoformat(lottery["ends_at"]).strftime('%d.%m.%Y в %H:%M')
     
     text = (
@@ -378,103 +708,150 @@ async def view_lottery_details(callback: CallbackQuery):
         f"💰 Цена билета: {lottery['ticket_price']} звезд\n"
         f"⏰ Завершится: {ends_date}\n"
         f"🎫 Продано билетов: {lottery['sold_tickets']}\n"
-        f"👥 Участников: {len(lottery.get('participants', {}))}\n\n"
-        f"⭐ Твой баланс: {user_balance} звезд"
+        f"👥 Участников: {len(lottery_users(lottery))}\n"
+        + (f"🔐 Хеш сида: <code>{lottery['draw_commitment'][:16]}…</code>\n" if "draw_commitment" in lottery else "")
     )
     
-    builder = InlineKeyboardBuilder()
-    
-    if user_balance >= lottery["ticket_price"]:
-        builder.row(
-            types.InlineKeyboardButton(
-                text=f"✅ КУПИТЬ БИЛЕТ за {lottery['ticket_price']}⭐",
-                callback_data=f"buy_ticket_{lottery_id}"
-            )
+    price = lottery["ticket_price"]
+    buy_buttons = {
+        count: types.InlineKeyboardButton(
+            text=f"✅ КУПИТЬ БИЛЕТ за {price}⭐" if count == 1 else f"🎫 x{count} за {price * count}⭐",
+            callback_data=f"buy_ticket_{lottery_id}" if count == 1 else f"buy_ticket_{lottery_id}_{count}"
         )
+        for count in TICKET_QUANTITIES
+    }
+    return {
+        "text": text,
+        "price": price,
+        "buy": buy_buttons,
+        "custom": types.InlineKeyboardButton(text="✍️ Свое количество", callback_data=f"buy_custom_{lottery_id}"),
+        "deposit": types.InlineKeyboardButton(text="💳 ПОПОЛНИТЬ БАЛАНС", callback_data="deposit_funds"),
+        "back": types.InlineKeyboardButton(text="⬅️ НАЗАД", callback_data="back_to_lotteries"),
+    }
+
+def lottery_card_for_user(lottery_id, user_id):
+    """Карточка из кэша + баланс и кнопки, зависящие от пользователя"""
+    card = lottery_card(lottery_id)
+    users = store.data["users"]
+    user_balance = users[user_id]["balance"] if user_id in users else 0
+    
+    rows = []
+    if user_balance >= card["price"]:
+        rows.append([card["buy"][1]])
+        affordable = [
+            card["buy"][count] for count in TICKET_QUANTITIES[1:]
+            if user_balance >= card["price"] * count
+        ]
+        if affordable:
+            rows.append(affordable)
+        rows.append([card["custom"]])
     else:
-        builder.row(
-            types.InlineKeyboardButton(
-                text="💳 ПОПОЛНИТЬ БАЛАНС",
-                callback_data="deposit_funds"
-            )
-        )
+        rows.append([card["deposit"]])
+    rows.append([card["back"]])
     
-    builder.row(
-        types.InlineKeyboardButton(
-            text="⬅️ НАЗАД",
-            callback_data="back_to_lotteries"
-        )
-    )
-    
-    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    text = card["text"] + f"\n⭐ Твой баланс: {user_balance} звезд"
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
 
-@router.callback_query(F.data.startswith("buy_ticket_"))
-async def buy_ticket_process(callback: CallbackQuery):
-    lottery_id = callback.data.replace("buy_ticket_", "")
-    user_id = str(callback.from_user.id)
-    data = load_data()
+@router.callback_query(F.data.startswith("view_lottery_"))
+async def view_lottery_details(callback: CallbackQuery):
+    lottery_id = callback.data.replace("view_lottery_", "")
     
-    if lottery_id not in data["active_lotteries"]:
+    if lottery_id not in store.data["active_lotteries"]:
         await callback.answer("❌ Розыгрыш не найден!")
         return
     
-    lottery = data["active_lotteries"][lottery_id]
-    
-    if user_id not in data["users"]:
-        data["users"][user_id] = {
-            "balance": 0,
-            "total_spent": 0,
-            "total_tickets": 0,
-            "username": callback.from_user.username,
-            "first_name": callback.from_user.first_name
-        }
+    text, keyboard = lottery_card_for_user(lottery_id, str(callback.from_user.id))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@router.callback_query(F.data == "back_to_lotteries")
+async def back_to_lotteries(callback: CallbackQuery):
+    keyboard, total = lottery_picker("buy", "soon", 0)
     
-    user_data = data["users"][user_id]
+    if not total:
+        await callback.message.edit_text("📭 Сейчас нет активных розыгрышей")
+    else:
+        await callback.message.edit_text(buy_menu_text(str(callback.from_user.id)), reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("buy_ticket_"))
+async def buy_ticket_process(callback: CallbackQuery):
+    # buy_ticket_<id> или buy_ticket_<id>_<количество>
+    lottery_id, _, count = callback.data.replace("buy_ticket_", "").partition("_")
+    count = int(count) if count.isdigit() else 1
     
-    if user_data["balance"] < lottery["ticket_price"]:
-        await callback.answer("❌ Не хватает звезд!")
+    # Покупка билетов
+    try:
+        lottery, user_data, ticket_numbers = await purchase_tickets(lottery_id, callback.from_user, count)
+    except PurchaseError as e:
+        await callback.answer(str(e))
         return
     
-    # Покупка билета
-    user_data["balance"] -= lottery["ticket_price"]
-    user_data["total_spent"] += lottery["ticket_price"]
-    user_data["total_tickets"] += 1
+    await callback.message.edit_text(purchase_text(lottery, user_data, ticket_numbers))
+
+@router.callback_query(F.data.startswith("buy_custom_"))
+async def buy_custom_count(callback: CallbackQuery, state: FSMContext):
+    lottery_id = callback.data.replace("buy_custom_", "")
     
-    ticket_number = generate_ticket_number()
+    if lottery_id not in store.data["active_lotteries"]:
+        await callback.answer("❌ Розыгрыш не найден!")
+        return
     
-    if user_id not in lottery["participants"]:
-        lottery["participants"][user_id] = []
+    await state.update_data(lottery_id=lottery_id)
+    await state.set_state(BuyerStates.waiting_for_ticket_count)
+    await callback.message.answer(
+        "✍️ <b>Сколько билетов купить?</b>\n"
+        f"<i>Введи число от 1 до {MAX_TICKETS_PER_PURCHASE}</i>",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_ticket_count")]
+        ])
+    )
+    await callback.answer()
+
+@router.callback_query(F.data == "cancel_ticket_count")
+async def cancel_ticket_count(callback: CallbackQuery, state: FSMContext):
+    if await state.get_state() == BuyerStates.waiting_for_ticket_count.state:
+        await state.clear()
+    await callback.message.edit_text("❌ Покупка отменена")
+    await callback.answer()
+
+@router.message(BuyerStates.waiting_for_ticket_count, Command("cancel"))
+async def cancel_ticket_count_command(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer("❌ Покупка отменена")
+
+@router.message(BuyerStates.waiting_for_ticket_count, F.text.in_(MENU_BUTTONS))
+async def leave_ticket_count(message: Message, state: FSMContext):
+    """Кнопка меню вместо числа: выходим из ввода, кнопку обработает ее обработчик.
+
+    Фильтры следующих обработчиков видят состояние на момент прихода
+    апдейта, поэтому ввод числа сам исключает кнопки меню.
+    """
+    await state.clear()
+    raise SkipHandler()
+
+@router.message(BuyerStates.waiting_for_ticket_count, ~F.text.in_(MENU_BUTTONS))
+async def process_ticket_count(message: Message, state: FSMContext):
+    try:
+        count = int(message.text)
+    except (TypeError, ValueError):
+        await message.answer("❌ Введи нормальное число!")
+        return
     
-    lottery["participants"][user_id].append(ticket_number)
-    lottery["tickets"].append({
-        "number": ticket_number,
-        "user_id": user_id,
-        "username": callback.from_user.username,
-        "first_name": callback.from_user.first_name,
-        "purchased_at": datetime.now().isoformat()
-    })
-    lottery["sold_tickets"] += 1
+    if not 1 <= count <= MAX_TICKETS_PER_PURCHASE:
+        await message.answer(f"❌ Можно купить от 1 до {MAX_TICKETS_PER_PURCHASE} билетов!")
+        return
     
-    save_data(data)
+    data = await state.get_data()
+    lottery_id = data["lottery_id"]
+    await state.clear()
     
-    await callback.message.edit_text(
-        f"🎉 <b>БИЛЕТ КУПЛЕН!</b>\n\n"
-        f"🎫 Номер билета: <code>{ticket_number}</code>\n"
-        f"💰 Стоимость: {lottery['ticket_price']} звезд\n"
-        f"⭐ Остаток: {user_data['balance']} звезд\n\n"
-        f"🍀 Удачи в розыгрыше!"
-    )
+    try:
+        lottery, user_data, ticket_numbers = await purchase_tickets(lottery_id, message.from_user, count)
+    except PurchaseError as e:
+        await message.answer(str(e))
+        return
     
-    # Уведомление админу
-    if MAIN_ADMIN_ID:
-        await bot.send_message(
-            MAIN_ADMIN_ID,
-            f"🛒 НОВАЯ ПОКУПКА!\n"
-            f"👤 @{callback.from_user.username or 'без username'}\n"
-            f"🎪 Розыгрыш: {lottery_id}\n"
-            f"🎫 Билет: {ticket_number}\n"
-            f"💰 Цена: {lottery['ticket_price']}⭐"
-        )
+    await message.answer(purchase_text(lottery, user_data, ticket_numbers))
 
 # ========================
 # 📊 СТАТИСТИКА
@@ -482,63 +859,156 @@ async def buy_ticket_process(callback: CallbackQuery):
 
 @router.message(F.text == "📊 Статистика")
 async def show_statistics(message: Message):
-    data = load_data()
-    
-    active_count = len(data["active_lotteries"])
-    ended_count = len(data["ended_lotteries"])
-    total_users = len(data["users"])
-    
-    total_balance = sum(user["balance"] for user in data["users"].values())
-    total_spent = sum(user["total_spent"] for user in data["users"].values())
+    # Счетчики обновляются при каждой операции, здесь ничего не пересчитываем
+    stats = store.aggregates
     
     stats_text = (
         f"📊 <b>СТАТИСТИКА БОТА</b>\n\n"
-        f"🎪 Активных розыгрышей: {active_count}\n"
-        f"🏁 Завершенных: {ended_count}\n"
-        f"👥 Пользователей: {total_users}\n\n"
-        f"💰 Общий баланс: {total_balance} ⭐\n"
-        f"💸 Потрачено: {total_spent} ⭐\n"
+        f"🎪 Активных розыгрышей: {stats.active_lotteries}\n"
+        f"🏁 Завершенных: {stats.ended_lotteries}\n"
+        f"👥 Пользователей: {stats.total_users}\n\n"
+        f"💰 Общий баланс: {stats.total_balance} ⭐\n"
+        f"💳 Пополнено: {stats.total_deposited} ⭐\n"
+        f"💸 Потрачено: {stats.total_spent} ⭐\n"
+        f"🎫 Продано билетов: {stats.tickets_sold}\n"
     )
     
+    if stats.active_lotteries:
+        stats_text += "\n<b>💵 Выручка активных:</b>\n"
+        for lottery_id in store.data["active_lotteries"]:
+            stats_text += f"• <code>{lottery_id}</code>: {stats.revenue.get(lottery_id, 0)} ⭐\n"
+    
     await message.answer(stats_text)
 
+@router.message(Command("check_stats"))
+async def check_statistics(message: Message):
+    """Сверка счетчиков с полным пересчетом"""
+    if message.from_user.id != MAIN_ADMIN_ID:
+        await message.answer("🚫 Только для администратора!")
+        return
+    
+    mismatches = store.check_aggregates()
+    if not mismatches:
+        await message.answer("✅ Счетчики сходятся с данными")
+        return
+    
+    lines = "\n".join(f"• {field}: {ours} → {fresh}" for field, (ours, fresh) in mismatches.items())
+    await message.answer(f"⚠️ <b>Счетчики исправлены:</b>\n{lines}")
+
+@router.message(Command("throttle"))
+async def throttle_settings(message: Message):
+    """/throttle — лимиты и отказы, /throttle <обработчик|default> <rate/burst> — новый лимит"""
+    if message.from_user.id != MAIN_ADMIN_ID:
+        await message.answer("🚫 Только для администратора!")
+        return
+    
+    parts = message.text.split()
+    if len(parts) == 3:
+        try:
+            throttling.set_limit(parts[1], parse_limit(parts[2]))
+        except ValueError:
+            await message.answer("❌ Формат: /throttle &lt;обработчик|default&gt; &lt;в секунду/запас&gt;")
+            return
+    
+    rate, burst = throttling.default
+    text = f"🚦 <b>ОГРАНИЧЕНИЕ ЧАСТОТЫ</b>\n\nПо умолчанию: {rate:g}/с, запас {burst:g}\n"
+    for handler, (rate, burst) in sorted(throttling.limits.items()):
+        text += f"• <code>{handler}</code>: {rate:g}/с, запас {burst:g}\n"
+    if throttling.rejected:
+        text += "\n<b>Отклонено:</b>\n"
+        for handler, count in sorted(throttling.rejected.items(), key=lambda item: -item[1]):
+            text += f"• <code>{handler}</code>: {count}\n"
+    text += f"\nАктивных бакетов: {len(throttling.buckets)}"
+    await message.answer(text)
+
 # ========================
 # 📋 МОИ БИЛЕТЫ
 # ========================
 
-@router.message(F.text == "📋 Мои билеты")
-async def my_tickets(message: Message):
-    user_id = str(message.from_user.id)
-    data = load_data()
-    
-    user_tickets = []
-    
-    # Ищем билеты в активных розыгрышах
-    for lottery_id, lottery in data["active_lotteries"].items():
-        if user_id in lottery.get("participants", {}):
-            tickets = lottery["participants"][user_id]
-            for ticket in tickets:
-                user_tickets.append({
-                    "lottery_id": lottery_id,
-                    "ticket": ticket,
-                    "status": "активен",
-                    "prize_count": lottery["prize_count"]
-                })
-    
-    if not user_tickets:
-        await message.answer("🎫 У вас пока нет билетов")
-        return
+def my_tickets_page(user_id, direction=None, cursor=None):
+    """Страница «Моих билетов»: текст и клавиатура.
+
+    Розыгрыши берутся из обратного индекса, поэтому страница стоит
+    O(размер страницы), а не O(всех розыгрышей). direction — "older"
+    или "newer" относительно розыгрыша cursor; без них — самые новые.
+    """
+    total = store.user_tickets.count(user_id)
+    if not total:
+        return "🎫 У вас пока нет билетов", None
+    
+    lottery = store.find_lottery(cursor) if cursor else None
+    key = store.user_tickets.key(lottery) if lottery else None
+    page, newer, older = store.user_tickets.page(
+        user_id, MY_TICKETS_PAGE_SIZE,
+        older_than=key if direction == "older" else None,
+        newer_than=key if direction == "newer" else None
+    )
+    if not page:
+        page, newer, older = store.user_tickets.page(user_id, MY_TICKETS_PAGE_SIZE)
     
-    tickets_text = "🎫 <b>ВАШИ БИЛЕТЫ:</b>\n\n"
-    for i, ticket in enumerate(user_tickets, 1):
+    tickets_text = f"🎫 <b>ВАШИ БИЛЕТЫ</b> ({newer + 1}–{newer + len(page)} из {total}):\n\n"
+    archived = []
+    for i, lottery_id in enumerate(page, newer + 1):
+        lottery = store.find_lottery(lottery_id)
+        
+        if lottery.get("is_active", True):
+            status = "активен"
+        else:
+            won = [w["ticket"] for w in lottery.get("winners", []) if w["user_id"] == user_id]
+            status = f"🏆 выигрыш: {', '.join(map(str, won))}" if won else "завершен"
+        
+        if lottery.get("archived"):
+            # Номера лежат в архиве и показываются в итогах розыгрыша
+            count = lottery["ticket_counts"][user_id]
+            numbers = "в итогах розыгрыша"
+            archived.append(lottery_id)
+        else:
+            count = lottery["tickets"].count(user_id)
+            tickets = lottery["tickets"].numbers_of(user_id, MY_TICKETS_SHOWN_NUMBERS)
+            numbers = ", ".join(f"<code>{ticket}</code>" for ticket in tickets)
+            if count > MY_TICKETS_SHOWN_NUMBERS:
+                numbers += f" и еще {count - MY_TICKETS_SHOWN_NUMBERS}"
+        
         tickets_text += (
-            f"{i}. Розыгрыш <code>{ticket['lottery_id']}</code>\n"
-            f"   Билет: <code>{ticket['ticket']}</code>\n"
-            f"   Статус: {ticket['status']}\n"
-            f"   Призовых мест: {ticket['prize_count']}\n\n"
+            f"{i}. Розыгрыш <code>{lottery_id}</code>\n"
+            f"   Билеты ({count}): {numbers}\n"
+            f"   Статус: {status}\n"
+            f"   Призовых мест: {lottery['prize_count']}\n\n"
         )
     
-    await message.answer(tickets_text)
+    rows = [
+        [types.InlineKeyboardButton(text=f"🔍 Итоги {lottery_id}", callback_data=f"results_{lottery_id}")]
+        for lottery_id in archived
+    ]
+    buttons = []
+    if newer:
+        buttons.append(types.InlineKeyboardButton(
+            text="⬅️ Новее",
+            callback_data=f"my_tickets_newer_{page[0]}"
+        ))
+    if older:
+        buttons.append(types.InlineKeyboardButton(
+            text="Старее ➡️",
+            callback_data=f"my_tickets_older_{page[-1]}"
+        ))
+    if buttons:
+        rows.append(buttons)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+    return tickets_text, keyboard
+
+@router.message(F.text == "📋 Мои билеты")
+async def my_tickets(message: Message):
+    text, keyboard = my_tickets_page(str(message.from_user.id))
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith("my_tickets_"))
+async def my_tickets_navigate(callback: CallbackQuery):
+    # my_tickets_<older|newer>_<ID розыгрыша>; старые кнопки со смещением
+    # открывают первую страницу
+    direction, _, cursor = callback.data.replace("my_tickets_", "").partition("_")
+    text, keyboard = my_tickets_page(str(callback.from_user.id), direction, cursor)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
 # ========================
 # 🏁 ЗАВЕРШЕНИЕ РОЗЫГРЫША
@@ -550,81 +1020,100 @@ async def end_lottery_menu(message: Message):
         await message.answer("🚫 Только для администратора!")
         return
     
-    data = load_data()
+    keyboard, total = lottery_picker("end", "soon", 0)
     
-    if not data["active_lotteries"]:
+    if not total:
         await message.answer("📭 Нет активных розыгрышей")
         return
     
-    builder = InlineKeyboardBuilder()
-    for lottery_id, lottery in data["active_lotteries"].items():
-        ends_date = datetime.fromisoformat(lottery["ends_at"]).strftime('%d.%m %H:%M')
-        builder.row(
-            types.InlineKeyboardButton(
-                text=f"🎪 #{lottery_id} - {lottery['sold_tickets']} билетов - до {ends_date}",
-                callback_data=f"end_lottery_{lottery_id}"
-            )
-        )
-    
     await message.answer(
         "🏁 <b>Выбери розыгрыш для завершения:</b>",
-        reply_markup=builder.as_markup()
+        reply_markup=keyboard
     )
 
-@router.callback_query(F.data.startswith("end_lottery_"))
-async def end_lottery_callback(callback: CallbackQuery):
+@router.callback_query(F.data.startswith("endmenu_"))
+async def end_lottery_menu_page(callback: CallbackQuery):
     if callback.from_user.id != MAIN_ADMIN_ID:
         await callback.answer("🚫 Только для администратора!")
         return
     
-    lottery_id = callback.data.replace("end_lottery_", "")
-    data = load_data()
-    
-    if lottery_id not in data["active_lotteries"]:
-        await callback.answer("❌ Розыгрыш не найден!")
-        return
-    
-    lottery = data["active_lotteries"][lottery_id]
-    
-    # Определяем победителей
-    tickets = lottery.get("tickets", [])
-    participants = list(lottery.get("participants", {}).keys())
-    prize_count = lottery["prize_count"]
+    _, sort, page = callback.data.split("_")
+    keyboard, total = lottery_picker("end", sort, int(page))
     
-    winners = []
-    
-    if tickets and len(participants) > 0:
-        all_tickets = [ticket for ticket in tickets]
-        actual_prize_count = min(prize_count, len(all_tickets))
+    if not total:
+        await callback.message.edit_text("📭 Нет активных розыгрышей")
+    else:
+        await callback.message.edit_text("🏁 <b>Выбери розыгрыш для завершения:</b>", reply_markup=keyboard)
+    await callback.answer()
+
+async def close_lottery(lottery_id):
+    """Завершаем розыгрыш и разыгрываем призы.
+
+    Возвращает завершенный розыгрыш или None, если он уже не активен.
+    """
+    if not await finish_lottery(lottery_id=lottery_id):
+        return None
+    return store.data["ended_lotteries"][lottery_id]
+
+@commands
+async def finish_lottery(lottery_id):
+    # Пока розыгрыш завершается, покупки в нем ждут
+    async with locks.hold(f"lottery:{lottery_id}"):
+        lottery = store.data["active_lotteries"].get(lottery_id)
+        if lottery is None:
+            return False
         
-        if actual_prize_count > 0:
-            winner_tickets = random.sample(all_tickets, actual_prize_count)
-            
-            for ticket in winner_tickets:
-                winners.append({
-                    "user_id": ticket["user_id"],
-                    "username": ticket["username"] or "без username",
-                    "first_name": ticket["first_name"] or "Пользователь",
-                    "ticket": ticket["number"]
-                })
-    
-    # Сохраняем результаты
-    lottery["ended_at"] = datetime.now().isoformat()
-    lottery["is_active"] = False
-    lottery["winners"] = winners
-    
-    data["ended_lotteries"][lottery_id] = lottery
-    del data["active_lotteries"][lottery_id]
-    
-    save_data(data)
+        # Определяем победителей
+        winners, draw = draw_lottery(lottery, store.data["users"], lottery.get("one_prize_per_user", False))
+        
+        # Сохраняем результаты
+        await store.commit({
+            "op": "close_lottery",
+            "lottery_id": lottery_id,
+            "winners": winners,
+            "draw": draw,
+            "ended_at": datetime.now().isoformat()
+        })
+    
+    notify_lottery_results(lottery)
+    # Билеты больше не нужны в горячем состоянии
+    store.archive_later(lottery_id)
+    return True
+
+def notify_lottery_results(lottery):
+    """Ставим в очередь поздравления победителям и итоги участникам"""
+    lottery_id = lottery["id"]
+    winning = {}
+    for place, winner in enumerate(lottery["winners"], 1):
+        winning.setdefault(winner["user_id"], []).append((place, winner["ticket"]))
+    
+    for user_id, prizes in winning.items():
+        lines = "\n".join(f"🏅 {place} место — билет <code>{ticket}</code>" for place, ticket in prizes)
+        outbox.send(
+            int(user_id),
+            f"🎉 <b>ПОЗДРАВЛЯЕМ!</b>\n\n"
+            f"Ты выиграл в розыгрыше <code>{lottery_id}</code>!\n{lines}\n\n"
+            f"🔐 Сид для проверки: <code>{lottery['draw']['secret']}</code>"
+        )
     
-    # Отчет администратору
+    if NOTIFY_PARTICIPANTS:
+        for user_id in lottery_users(lottery):
+            if user_id not in winning:
+                outbox.send(
+                    int(user_id),
+                    f"🏁 Розыгрыш <code>{lottery_id}</code> завершен.\n"
+                    f"В этот раз без приза — удачи в следующих! 🍀"
+                )
+
+def lottery_report(lottery):
+    """Отчет администратору о завершенном розыгрыше"""
+    winners = lottery["winners"]
     report = (
         f"✅ <b>РОЗЫГРЫШ ЗАВЕРШЕН!</b>\n\n"
-        f"🎪 ID: {lottery_id}\n"
-        f"🏆 Призовых мест: {prize_count}\n"
+        f"🎪 ID: {lottery['id']}\n"
+        f"🏆 Призовых мест: {lottery['prize_count']}\n"
         f"🎫 Билетов продано: {lottery['sold_tickets']}\n"
-        f"👥 Участников: {len(participants)}\n"
+        f"👥 Участников: {len(lottery_users(lottery))}\n"
         f"🏅 Победителей: {len(winners)}\n\n"
     )
     
@@ -633,9 +1122,147 @@ async def end_lottery_callback(callback: CallbackQuery):
         for i, winner in enumerate(winners, 1):
             report += f"{i}. {winner['first_name']} (@{winner['username']}) - билет {winner['ticket']}\n"
     
-    await callback.message.edit_text(report)
+    # У розыгрышей до commit-reveal сида нет
+    if "draw" in lottery:
+        report += (
+            f"\n🔐 Сид: <code>{lottery['draw']['secret']}</code>\n"
+            f"<i>sha256 от сида: {lottery['draw']['commitment']}</i>"
+        )
+    return report
+
+@router.callback_query(F.data.startswith("end_lottery_"))
+async def end_lottery_callback(callback: CallbackQuery):
+    if callback.from_user.id != MAIN_ADMIN_ID:
+        await callback.answer("🚫 Только для администратора!")
+        return
+    
+    lottery_id = callback.data.replace("end_lottery_", "")
+    lottery = await close_lottery(lottery_id)
+    
+    if lottery is None:
+        await callback.answer("❌ Розыгрыш не найден!")
+        return
+    
+    # Отчет администратору
+    await callback.message.edit_text(lottery_report(lottery))
     await callback.answer("✅ Розыгрыш завершен!")
 
+# ========================
+# 🔍 ИТОГИ ПРОШЛЫХ РОЗЫГРЫШЕЙ
+# ========================
+
+async def results_text(lottery_id, user_id):
+    """Итоги завершенного розыгрыша; архив читается только здесь"""
+    lottery = await store.full_lottery(lottery_id)
+    if lottery is None or lottery.get("is_active", True):
+        return None
+    
+    text = lottery_report(lottery)
+    count = lottery["tickets"].count(user_id)
+    if count:
+        tickets = lottery["tickets"].numbers_of(user_id, MY_TICKETS_SHOWN_NUMBERS)
+        numbers = ", ".join(f"<code>{ticket}</code>" for ticket in tickets)
+        if count > MY_TICKETS_SHOWN_NUMBERS:
+            numbers += f" и еще {count - MY_TICKETS_SHOWN_NUMBERS}"
+        text += f"\n\n🎫 Твои билеты ({count}): {numbers}"
+    if "draw" in lottery:
+        text += "\n✅ Победители сходятся с сидом" if verify_draw(lottery) else "\n⚠️ Победители не сходятся с сидом!"
+    return text
+
+@router.callback_query(F.data.startswith("results_"))
+async def lottery_results_callback(callback: CallbackQuery):
+    text = await results_text(callback.data.replace("results_", ""), str(callback.from_user.id))
+    if text is None:
+        await callback.answer("❌ Розыгрыш не найден!")
+        return
+    await callback.message.answer(text)
+    await callback.answer()
+
+@router.message(Command("results"))
+async def lottery_results_command(message: Message):
+    """/results <id> — итоги завершенного розыгрыша"""
+    parts = message.text.split()
+    text = await results_text(parts[1], str(message.from_user.id)) if len(parts) > 1 else None
+    if text is None:
+        await message.answer("❌ Розыгрыш не найден! Формат: /results &lt;id&gt;")
+        return
+    await message.answer(text)
+
+# ========================
+# ⏰ АВТОЗАВЕРШЕНИЕ
+# ========================
+
+class ExpiryScheduler:
+    """Завершает розыгрыши по ends_at.
+
+    Сроки лежат в куче, поэтому планировщик спит ровно до ближайшего
+    срока и не перебирает розыгрыши. Записи о розыгрышах, завершенных
+    вручную, просто пропускаются при извлечении.
+    """
+
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self.heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def schedule(self, lottery_id, ends_at):
+        deadline = datetime.fromisoformat(ends_at).timestamp()
+        heapq.heappush(self.heap, (deadline, lottery_id))
+        # Разбудим, если новый срок раньше текущего
+        if self.heap[0][1] == lottery_id:
+            self._wakeup.set()
+
+    def rebuild(self, lotteries):
+        """Очередь из состояния; просроченные за время простоя завершатся сразу"""
+        self.heap = [
+            (datetime.fromisoformat(lottery["ends_at"]).timestamp(), lottery_id)
+            for lottery_id, lottery in lotteries.items()
+        ]
+        heapq.heapify(self.heap)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = datetime.now().timestamp()
+            while self.heap and self.heap[0][0] <= now:
+                _, lottery_id = heapq.heappop(self.heap)
+                try:
+                    await self.on_expire(lottery_id)
+                except Exception:
+                    logger.exception(f"❌ Не удалось автоматически завершить розыгрыш {lottery_id}")
+            
+            timeout = self.heap[0][0] - now if self.heap else None
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait([waiter], timeout=timeout)
+            finally:
+                waiter.cancel()
+            self._wakeup.clear()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+async def expire_lottery(lottery_id):
+    """Розыгрыш дошел до ends_at"""
+    lottery = await close_lottery(lottery_id)
+    if lottery is None:
+        return
+    logger.info(f"⏰ Розыгрыш {lottery_id} завершен по времени")
+    if MAIN_ADMIN_ID:
+        outbox.send(MAIN_ADMIN_ID, "⏰ <b>Время вышло!</b>\n\n" + lottery_report(lottery))
+
+expiry = ExpiryScheduler(expire_lottery)
+
 # ========================
 # 💰 БАЛАНС
 # ========================
@@ -643,7 +1270,7 @@ async def end_lottery_callback(callback: CallbackQuery):
 @router.message(F.text == "💰 Баланс")
 async def show_balance(message: Message):
     user_id = str(message.from_user.id)
-    data = load_data()
+    data = store.data
     
     if user_id in data["users"]:
         user_data = data["users"][user_id]
@@ -657,57 +1284,462 @@ async def show_balance(message: Message):
     else:
         balance_text = "💰 У вас еще нет баланса\n⭐ Пополните для участия в розыгрышах!"
     
-    await message.answer(balance_text)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="💳 ПОПОЛНИТЬ БАЛАНС", callback_data="deposit_funds")
+    ]])
+    await message.answer(balance_text, reply_markup=keyboard)
+
+# ========================
+# ⭐ ПОПОЛНЕНИЕ ЗВЕЗДАМИ
+# ========================
+#
+# Счет в звездах (XTR) → Telegram спрашивает pre_checkout_query, можно
+# ли принять оплату → после оплаты приходит сообщение с successful_payment,
+# и только оно зачисляет звезды. Повтор того же платежа (тот же
+# telegram_payment_charge_id) второй раз не зачисляется.
+
+def deposit_payload(amount):
+    return f"deposit:{amount}"
+
+def parse_deposit_payload(payload):
+    """Сумма из payload счета или None"""
+    kind, _, amount = payload.partition(":")
+    if kind != "deposit" or not amount.isdigit():
+        return None
+    amount = int(amount)
+    return amount if 1 <= amount <= DEPOSIT_MAX else None
+
+async def send_deposit_invoice(message, amount):
+    await message.answer_invoice(
+        title=f"Пополнение на {amount} ⭐",
+        description="Звезды зачисляются на баланс бота и тратятся на билеты розыгрышей",
+        payload=deposit_payload(amount),
+        provider_token="",
+        currency="XTR",
+        prices=[LabeledPrice(label=f"{amount} ⭐", amount=amount)]
+    )
+
+@payments_router.callback_query(F.data == "deposit_funds")
+async def deposit_funds(callback: CallbackQuery):
+    builder = InlineKeyboardBuilder()
+    for amount in DEPOSIT_AMOUNTS:
+        builder.button(text=f"⭐ {amount}", callback_data=f"deposit_{amount}")
+    builder.adjust(2)
+    await callback.message.answer(
+        "💳 <b>ПОПОЛНЕНИЕ БАЛАНСА</b>\n\n"
+        "Выбери сумму — оплата звездами Telegram, 1 ⭐ = 1 звезда на балансе.\n"
+        f"<i>Другую сумму до {DEPOSIT_MAX} можно ввести командой /deposit &lt;сумма&gt;</i>",
+        reply_markup=builder.as_markup()
+    )
+    await callback.answer()
+
+@payments_router.callback_query(F.data.startswith("deposit_"))
+async def deposit_amount_chosen(callback: CallbackQuery):
+    amount = parse_deposit_payload(callback.data.replace("deposit_", "deposit:"))
+    if amount is None:
+        await callback.answer("❌ Неверная сумма!")
+        return
+    await send_deposit_invoice(callback.message, amount)
+    await callback.answer()
+
+@payments_router.message(Command("deposit"))
+async def deposit_command(message: Message):
+    parts = message.text.split()
+    amount = parse_deposit_payload(f"deposit:{parts[1]}") if len(parts) == 2 else None
+    if amount is None:
+        await message.answer(f"❌ Формат: /deposit &lt;сумма от 1 до {DEPOSIT_MAX}&gt;")
+        return
+    await send_deposit_invoice(message, amount)
+
+@payments_router.pre_checkout_query()
+async def deposit_pre_checkout(query: PreCheckoutQuery):
+    """Подтверждаем оплату; ответить нужно в течение 10 секунд"""
+    amount = parse_deposit_payload(query.invoice_payload)
+    if amount is None or query.currency != "XTR" or query.total_amount != amount:
+        logger.warning(f"⚠️ Отклонен платеж {query.from_user.id}: {query.invoice_payload} {query.total_amount} {query.currency}")
+        await query.answer(ok=False, error_message="Счет устарел. Создай новый в меню пополнения.")
+        return
+    await query.answer(ok=True)
+
+@payments_router.message(F.successful_payment)
+async def deposit_paid(message: Message):
+    payment = message.successful_payment
+    if payment.currency != "XTR" or parse_deposit_payload(payment.invoice_payload) is None:
+        logger.error(f"❌ Непонятный платеж {payment.telegram_payment_charge_id}: {payment.invoice_payload}")
+        return
+    
+    user = message.from_user
+    credited = await deposit(
+        user_id=str(user.id),
+        username=user.username,
+        first_name=user.first_name,
+        amount=payment.total_amount,
+        charge_id=payment.telegram_payment_charge_id
+    )
+    if not credited:
+        return
+    
+    logger.info(f"⭐ Пополнение {user.id}: {payment.total_amount} звезд")
+    await message.answer(
+        f"✅ <b>БАЛАНС ПОПОЛНЕН!</b>\n\n"
+        f"⭐ Зачислено: {payment.total_amount} звезд\n"
+        f"💰 Баланс: {store.data['users'][str(user.id)]['balance']} звезд\n\n"
+        f"🎫 Теперь можно покупать билеты!"
+    )
+
+@commands
+async def deposit(user_id, username, first_name, amount, charge_id):
+    """Зачисляем оплату; False, если этот платеж уже зачислен"""
+    await register(user_id=user_id, username=username, first_name=first_name)
+    if charge_id in store.data["payments"]:
+        return False
+    await store.commit({
+        "op": "deposit",
+        "user_id": user_id,
+        "amount": amount,
+        "charge_id": charge_id,
+        "paid_at": datetime.now().isoformat()
+    })
+    return True
+
+# ========================
+# 📒 СВЕРКА БАЛАНСОВ
+# ========================
+
+LEDGER_MISMATCHES = Gauge("lottery_ledger_mismatches", "Пользователи, чей баланс разошелся с журналом балансов")
+
+@commands
+async def reconcile_balances():
+    """{user_id: [баланс, сумма по журналу]} для расхождений"""
+    mismatches = await store.reconcile_ledger()
+    LEDGER_MISMATCHES.set(len(mismatches))
+    return {user_id: list(pair) for user_id, pair in mismatches.items()}
+
+def mismatches_text(mismatches, limit=20):
+    lines = "\n".join(
+        f"• <code>{user_id}</code>: баланс {balance}, по журналу {total}"
+        for user_id, (balance, total) in list(mismatches.items())[:limit]
+    )
+    if len(mismatches) > limit:
+        lines += f"\n… и еще {len(mismatches) - limit}"
+    return f"⚠️ <b>Балансы разошлись с журналом: {len(mismatches)}</b>\n{lines}"
+
+class BalanceReconciler:
+    """Сверка балансов с журналом раз в interval секунд; расхождения — админу"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                mismatches = await reconcile_balances()
+            except Exception:
+                logger.exception("❌ Ошибка сверки балансов")
+                continue
+            if mismatches and MAIN_ADMIN_ID:
+                outbox.send(MAIN_ADMIN_ID, mismatches_text(mismatches))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+reconciler = BalanceReconciler(LEDGER_RECONCILE_INTERVAL)
+
+@router.message(Command("reconcile"))
+async def reconcile_command(message: Message):
+    """Сверка балансов с журналом по запросу"""
+    if message.from_user.id != MAIN_ADMIN_ID:
+        await message.answer("🚫 Только для администратора!")
+        return
+    
+    mismatches = await reconcile_balances()
+    if not mismatches:
+        await message.answer(f"✅ Балансы {len(store.data['users'])} пользователей сходятся с журналом")
+        return
+    await message.answer(mismatches_text(mismatches))
 
 # ========================
 # 🚀 FASTAPI ДЛЯ RENDER
 # ========================
+#
+# FastAPI и uvicorn нужны только на Render и в режиме webhook, поэтому
+# импортируются и собираются при запуске веб-сервера, а не при импорте бота.
 
-app = FastAPI()
+def data_file_sizes():
+    sizes = {}
+    for path in (DATA_FILE, SQLITE_FILE, JOURNAL_FILE, SNAPSHOT_FILE, OUTBOX_FILE, FSM_FILE, LEDGER_FILE):
+        if os.path.exists(path):
+            sizes[(path,)] = os.path.getsize(path)
+    return sizes
 
-@app.get("/")
-async def root():
-    return {
-        "status": "online", 
-        "service": "Telegram Lottery Bot",
-        "uptime": "24/7",
-        "admin": MAIN_ADMIN_ID
-    }
+Gauge("lottery_data_file_bytes", "Размер файлов данных", ["file"], func=data_file_sizes)
+Gauge("lottery_outbox_queued", "Сообщения в очереди на отправку", func=lambda: len(outbox))
+Gauge("lottery_state_pending_ops", "Операции, еще не записанные на диск", func=lambda: store.dirty)
+Gauge("lottery_users", "Пользователи", func=lambda: store.aggregates.total_users)
+Gauge("lottery_active_lotteries", "Активные розыгрыши", func=lambda: store.aggregates.active_lotteries)
 
-@app.get("/health")
-async def health():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+class RecentUpdates:
+    """Последние update_id: Telegram повторяет апдейт, если не дождался
+    ответа, и один и тот же апдейт не должен обработаться дважды"""
 
-@app.get("/stats")
-async def api_stats():
-    data = load_data()
-    return {
-        "active_lotteries": len(data["active_lotteries"]),
-        "total_users": len(data["users"]),
-        "timestamp": datetime.now().isoformat()
-    }
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def seen(self, update_id):
+        """True, если апдейт уже был; иначе запоминаем его"""
+        if update_id in self.ids:
+            return True
+        self.ids.add(update_id)
+        self.order.append(update_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return False
+
+recent_updates = RecentUpdates(WEBHOOK_DEDUP_SIZE)
+webhook_tasks = set()
+
+async def handle_webhook_update(update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception(f"❌ Ошибка при обработке апдейта {update.update_id}")
+
+def create_app():
+    """Веб-приложение: статус, статистика, метрики и прием webhook"""
+    from fastapi import FastAPI, Request, Response
+    from fastapi.responses import PlainTextResponse
+    
+    app = FastAPI()
+    
+    @app.get("/")
+    async def root():
+        return {
+            "status": "online", 
+            "service": "Telegram Lottery Bot",
+            "uptime": "24/7",
+            "admin": MAIN_ADMIN_ID,
+            "mode": "webhook" if WEBHOOK_URL else "polling"
+        }
+    
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    
+    @app.get("/stats")
+    async def api_stats():
+        return {
+            **store.aggregates.as_dict(),
+            "revenue": store.aggregates.revenue,
+            "startup_seconds": startup.phases,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+    
+    # ========================
+    # 🪝 WEBHOOK
+    # ========================
+    
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request):
+        """Принимаем апдейт и сразу отвечаем 200, обработка идет в фоне"""
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return Response(status_code=403)
+        
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        if recent_updates.seen(update.update_id):
+            return Response(status_code=200)
+        
+        task = asyncio.create_task(handle_webhook_update(update))
+        webhook_tasks.add(task)
+        task.add_done_callback(webhook_tasks.discard)
+        return Response(status_code=200)
+    
+    @app.on_event("startup")
+    async def on_app_startup():
+        """В режиме webhook бот живет в цикле событий uvicorn"""
+        if not WEBHOOK_URL:
+            return
+        await dp.emit_startup(bot=bot)
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🪝 Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    
+    @app.on_event("shutdown")
+    async def on_app_shutdown():
+        """Останавливаем бота, чтобы состояние успело сохраниться"""
+        if WEBHOOK_URL:
+            # Webhook не снимаем: при передеплое его уже поставил новый экземпляр
+            if webhook_tasks:
+                await asyncio.wait(list(webhook_tasks), timeout=10)
+            await dp.emit_shutdown(bot=bot)
+            await bot.session.close()
+            return
+        if bot_loop and bot_loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(dp.stop_polling(), bot_loop)
+            try:
+                await asyncio.wrap_future(future)
+            except RuntimeError:
+                pass
+    
+    return app
+
+def run_web_server():
+    """Запускаем uvicorn; импортируется только здесь"""
+    import uvicorn
+    port = int(os.environ.get("PORT", 8000))
+    logger.info(f"🌐 Веб-сервер запускается на порту {port}")
+    uvicorn.run(create_app(), host="0.0.0.0", port=port)
 
 # ========================
 # 🔄 ФУНКЦИЯ ЗАПУСКА БОТА
 # ========================
 
-async def run_bot():
+bot_loop = None
+
+def warm_state():
+    """Индексы и первые экраны готовим до первого апдейта"""
+    store.warm()
+    for sort in LOTTERY_SORTS:
+        lottery_picker("buy", sort, 0)
+    for lottery_id in store.data["active_lotteries"]:
+        lottery_card(lottery_id)
+
+@dp.startup()
+async def on_startup():
+    """Загружаем и прогреваем состояние, запускаем фоновую запись"""
+    with startup.phase("load"):
+        store.load()
+    with startup.phase("warm"):
+        warm_state()
+    await store.start()
+    expiry.rebuild(store.data["active_lotteries"])
+    store.archive_later(*(
+        lottery_id for lottery_id, lottery in store.data["ended_lotteries"].items()
+        if not lottery.get("archived")
+    ))
+    expiry.start()
+    outbox.load()
+    outbox.start()
+    purchase_digest.start()
+    reconciler.start()
+    if isinstance(storage, SqliteFSMStorage):
+        storage.start()
+    startup.mark("ready")
+    logger.info(f"📦 Состояние загружено: {len(store.data['users'])} пользователей")
+
+@dp.shutdown()
+async def on_shutdown():
+    """Сохраняем состояние перед выходом"""
+    await expiry.stop()
+    await reconciler.stop()
+    await purchase_digest.stop()
+    await outbox.stop()
+    await store.stop()
+
+async def run_bot(handle_signals=True):
     """Запускает Telegram бота"""
     logger.info("🤖 Telegram бот запускается...")
     logger.info(f"👑 Админ ID: {MAIN_ADMIN_ID}")
     logger.info(f"🌐 Режим: {'Render.com' if os.getenv('RENDER') else 'Локальный'}")
     
     try:
-        await dp.start_polling(bot)
+        await dp.start_polling(bot, handle_signals=handle_signals)
     except Exception as e:
         logger.error(f"❌ Ошибка в работе бота: {e}")
         raise
 
+# ========================
+# 🧩 ШАРДИРОВАННЫЙ ЗАПУСК
+# ========================
+
+async def poll_updates(route):
+    """Long polling владельца: апдейты не обрабатываются здесь, а раздаются воркерам"""
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+async def run_sharded():
+    """Процесс-владелец: состояние, фоновые задачи и раздача апдейтов"""
+    logger.info(f"🧩 Шардированный режим: {SHARD_WORKERS} воркеров")
+    await dp.emit_startup(bot=bot)
+    owner = StateOwner(
+        store, commands, SHARD_SOCKET, SHARD_WORKERS,
+        [sys.executable, os.path.abspath(__file__)],
+        errors=(PurchaseError,)
+    )
+    polling = None
+    try:
+        await owner.start()
+        polling = asyncio.create_task(poll_updates(owner.route))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, polling.cancel)
+        await polling
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if polling:
+            polling.cancel()
+        await owner.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+async def run_shard_worker(index):
+    """Воркер: обрабатывает апдейты своих пользователей, читая реплику"""
+    async def feed(update):
+        await dp.feed_update(bot, types.Update.model_validate(update, context={"bot": bot}))
+    
+    client = ShardClient(store, SHARD_SOCKET, index, feed, errors=(PurchaseError,))
+    with startup.phase("load"):
+        await client.connect()
+    with startup.phase("warm"):
+        warm_state()
+    startup.mark("ready")
+    commands.client = client
+    if isinstance(storage, SqliteFSMStorage):
+        storage.start()
+    try:
+        await client.run()
+    finally:
+        await storage.close()
+        await bot.session.close()
+
 def start_bot_in_thread():
     """Запускает бота в отдельном потоке"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_bot())
+    global bot_loop
+    bot_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(bot_loop)
+    # Сигналы ловит uvicorn в главном потоке
+    bot_loop.run_until_complete(run_bot(handle_signals=False))
+
+startup.mark("import")
 
 # ========================
 # 🚀 ГЛАВНАЯ ФУНКЦИЯ ЗАПУСКА
@@ -718,7 +1750,22 @@ def main():
     # Проверяем, запущены ли мы на Render
     is_render = os.getenv('RENDER') or os.getenv('PORT')
     
-    if is_render:
+    if SHARD_INDEX is not None:
+        # Воркер завершается, когда владелец закрывает соединение;
+        # Ctrl+C в терминале получает вся группа процессов
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        asyncio.run(run_shard_worker(int(SHARD_INDEX)))
+        
+    elif SHARD_WORKERS:
+        logger.info("🧩 Запуск в шардированном режиме")
+        asyncio.run(run_sharded())
+        
+    elif WEBHOOK_URL:
+        # Один цикл событий: uvicorn принимает апдейты и обслуживает бота
+        logger.info("🪝 Запуск в режиме webhook")
+        run_web_server()
+        
+    elif is_render:
         logger.info("🌐 Запуск в облачной среде Render.com")
         
         # Запускаем бота в отдельном потоке
@@ -727,9 +1774,7 @@ def main():
         logger.info("✅ Telegram бот запущен в фоновом режиме")
         
         # Запускаем веб-сервер (обязательно для Render)
-        port = int(os.environ.get("PORT", 8000))
-        logger.info(f"🌐 Веб-сервер запускается на порту {port}")
-        uvicorn.run(app, host="0.0.0.0", port=port)
+        run_web_server()
         
     else:
         logger.info("💻 Локальный запуск")
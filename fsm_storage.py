@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# ========================
+# 🧭 СОСТОЯНИЯ ДИАЛОГОВ (FSM)
+# ========================
+
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_expires ON fsm(expires_at);
+"""
+
+def _key_str(key):
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id,
+        key.business_connection_id, key.destiny
+    ))
+
+class SqliteFSMStorage(BaseStorage):
+    """FSM-хранилище в SQLite с кэшем в памяти.
+
+    Все записи при старте читаются в память, поэтому get_state/get_data
+    не ходят на диск. Каждое изменение сразу пишется в базу (WAL,
+    synchronous=NORMAL — без fsync на каждую запись), так что
+    недозаполненный мастер создания розыгрыша переживает перезапуск.
+
+    У каждой записи есть срок жизни: ttl по умолчанию или state_ttls
+    для конкретного состояния. Срок продлевается при каждом изменении,
+    просроченные записи читаются как пустые и удаляются фоновой уборкой.
+    """
+
+    def __init__(self, path, ttl=86400, state_ttls=None, cleanup_interval=300):
+        self.path = path
+        self.ttl = ttl
+        self.state_ttls = state_ttls or {}
+        self.cleanup_interval = cleanup_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(FSM_SCHEMA)
+        self.records = {}   # строка ключа -> [state, data, expires_at]
+        self._task = None
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        self.conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+        self.conn.commit()
+        for key, state, data, expires_at in self.conn.execute("SELECT key, state, data, expires_at FROM fsm"):
+            self.records[key] = [state, json.loads(data), expires_at]
+        if self.records:
+            logger.info(f"🧭 Восстановлено состояний диалогов: {len(self.records)}")
+
+    def _get(self, key):
+        record = self.records.get(key)
+        if record and record[2] <= time.time():
+            self._delete(key)
+            return None
+        return record
+
+    def _delete(self, key):
+        self.records.pop(key, None)
+        self.conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def _put(self, key, state, data):
+        if state is None and not data:
+            self._delete(key)
+            return
+        expires_at = time.time() + self.state_ttls.get(state, self.ttl)
+        self.records[key] = [state, data, expires_at]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+            (key, state, json.dumps(data, ensure_ascii=False), expires_at)
+        )
+        self.conn.commit()
+
+    async def set_state(self, key: StorageKey, state=None):
+        key = _key_str(key)
+        state = state.state if isinstance(state, State) else state
+        record = self._get(key)
+        self._put(key, state, record[1] if record else {})
+
+    async def get_state(self, key: StorageKey):
+        record = self._get(_key_str(key))
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data):
+        key = _key_str(key)
+        record = self._get(key)
+        self._put(key, record[0] if record else None, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        record = self._get(_key_str(key))
+        return dict(record[1]) if record else {}
+
+    # ---- уборка просроченных ----
+
+    def cleanup(self):
+        """Удаляем просроченные записи; возвращаем, сколько удалили"""
+        now = time.time()
+        expired = [key for key, record in self.records.items() if record[2] <= now]
+        for key in expired:
+            del self.records[key]
+        self.conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+        self.conn.commit()
+        return len(expired)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            removed = self.cleanup()
+            if removed:
+                logger.info(f"🧹 Удалено брошенных диалогов: {removed}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.conn.close()
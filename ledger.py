@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# ========================
+# 📒 ЖУРНАЛ БАЛАНСОВ
+# ========================
+#
+# Каждое изменение баланса — строка JSON в файле, который только
+# дописывается: пополнение (+), покупка билетов (−) и входящий остаток
+# (opening) для балансов, появившихся раньше журнала. Баланс в users —
+# материализованная сумма этих строк: его за O(1) обновляет сама
+# операция, а сверка пересчитывает суммы по журналу и сравнивает.
+#
+# Строки пишутся тем же фоновым сбросом, что и состояние, и раньше
+# него. Если процесс упал между ними, при загрузке хвост журнала новее
+# состояния (по seq) отрезается: его операции так и не записались.
+
+def ledger_entries(op):
+    """Строки журнала для операции состояния"""
+    kind = op["op"]
+    if kind == "deposit":
+        return [{
+            "seq": op["seq"], "user_id": op["user_id"], "amount": op["amount"],
+            "kind": "deposit", "ref": op["charge_id"], "at": op["paid_at"]
+        }]
+    if kind == "purchase":
+        return [{
+            "seq": op["seq"], "user_id": op["user_id"], "amount": -op["price"] * len(op["tickets"]),
+            "kind": "purchase", "ref": op["lottery_id"], "at": op["purchased_at"]
+        }]
+    return []
+
+class Ledger:
+    """Файл журнала балансов"""
+
+    TAIL_CHUNK = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.last_seq = 0
+
+    def open(self, data):
+        """Сверяем файл с загруженным состоянием перед первой записью"""
+        seq = data.get("seq", 0)
+        if not os.path.exists(self.path):
+            opening = [
+                {"seq": seq, "user_id": user_id, "amount": user["balance"], "kind": "opening", "ref": None,
+                 "at": None}
+                for user_id, user in data["users"].items() if user["balance"]
+            ]
+            self.append(opening)
+            if opening:
+                logger.info(f"📒 Журнал балансов создан, входящих остатков: {len(opening)}")
+        else:
+            removed = self._trim(seq)
+            if removed:
+                logger.warning(f"⚠️ Из журнала балансов отрезаны записи новее состояния: {removed} байт")
+        self.last_seq = seq
+
+    def _trim(self, seq):
+        """Отрезаем строки с seq новее состояния и недописанную строку; сколько байт убрали"""
+        with open(self.path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            start = end
+            keep = None
+            while keep is None and start > 0:
+                start = max(0, start - self.TAIL_CHUNK)
+                f.seek(start)
+                window = f.read(end - start)
+                # Конец последней целой строки; все после него — обрывок
+                cut = window.rfind(b"\n") + 1
+                while cut > 0:
+                    begin = window.rfind(b"\n", 0, cut - 1) + 1
+                    if begin == 0 and start > 0:
+                        break   # начало строки раньше окна: читаем больше
+                    if json.loads(window[begin:cut])["seq"] <= seq:
+                        keep = start + cut
+                        break
+                    cut = begin
+                else:
+                    if start == 0:
+                        keep = 0
+            if keep is None:
+                keep = 0
+            if keep < end:
+                f.truncate(keep)
+                f.flush()
+                os.fsync(f.fileno())
+            return end - keep
+
+    def append(self, entries):
+        """Дописываем строки и fsync; уже записанные (по seq) пропускаем.
+
+        Пропуск нужен для повтора после ошибки записи состояния: журнал к
+        тому моменту мог уже принять эти строки.
+        """
+        entries = [entry for entry in entries if entry["seq"] > self.last_seq or entry["kind"] == "opening"]
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if entries:
+            self.last_seq = max(self.last_seq, entries[-1]["seq"])
+
+    def balances(self, seq=None):
+        """Суммы по пользователям из всех строк с seq не новее заданного"""
+        totals = {}
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # строку еще дописывают
+                entry = json.loads(line)
+                if seq is not None and entry["seq"] > seq:
+                    continue
+                totals[entry["user_id"]] = totals.get(entry["user_id"], 0) + entry["amount"]
+        return totals
@@ -0,0 +1,228 @@
+import hashlib
+import secrets
+
+# ========================
+# 🎫 НОМЕРА БИЛЕТОВ
+# ========================
+#
+# Номер билета — это перестановка его порядкового номера в розыгрыше.
+# Перестановка задается секретным ключом розыгрыша (сеть Фейстеля +
+# cycle walking), поэтому номера выглядят случайными, но никогда не
+# повторяются, а выдача стоит O(1) по времени и памяти.
+#
+# Пространство номеров растет само: сначала 6-значные номера, когда
+# они заканчиваются — 7-значные и т.д. Диапазоны не пересекаются.
+
+FEISTEL_ROUNDS = 4
+FIRST_TICKET_DIGITS = 6
+
+def new_ticket_key():
+    """Секретный ключ перестановки для нового розыгрыша"""
+    return secrets.randbits(64)
+
+def _round(key, digits, rnd, value, bits):
+    digest = hashlib.blake2b(
+        value.to_bytes(8, 'little'),
+        digest_size=8,
+        key=key.to_bytes(8, 'little') + bytes((digits, rnd))
+    ).digest()
+    return int.from_bytes(digest, 'little') & ((1 << bits) - 1)
+
+def _permute(key, digits, index, size):
+    """Биекция [0, size) -> [0, size)"""
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    value = index
+    while True:
+        left, right = value >> half, value & mask
+        for rnd in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ _round(key, digits, rnd, right, half)
+        value = (left << half) | right
+        # Домен сети Фейстеля не больше 4*size, поэтому в среднем
+        # хватает пары шагов
+        if value < size:
+            return value
+
+def ticket_number(key, index, first_digits=FIRST_TICKET_DIGITS):
+    """Номер билета с порядковым номером index"""
+    digits = first_digits
+    while True:
+        low = 10 ** (digits - 1)
+        size = 9 * low
+        if index < size:
+            return low + _permute(key, digits, index, size)
+        index -= size
+        digits += 1
+
+def lottery_ticket_key(lottery):
+    """Ключ и разрядность первых номеров розыгрыша.
+
+    У розыгрышей, созданных до появления перестановки, номера брались
+    случайно из 6-значных, поэтому новые выдаем начиная с 7-значных,
+    а ключ выводим из ID.
+    """
+    if "ticket_key" in lottery:
+        return lottery["ticket_key"], lottery.get("ticket_digits", FIRST_TICKET_DIGITS)
+    digest = hashlib.blake2b(lottery["id"].encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little'), FIRST_TICKET_DIGITS + 1
+
+def allocate_tickets(lottery, count):
+    """Следующие count номеров розыгрыша.
+
+    Порядковый номер билета — sold_tickets, поэтому отдельный счетчик
+    хранить не нужно: он восстанавливается вместе с состоянием.
+    """
+    key, digits = lottery_ticket_key(lottery)
+    start = lottery["sold_tickets"]
+    return [ticket_number(key, index, digits) for index in range(start, start + count)]
+
+# ========================
+# 🎲 РОЗЫГРЫШ ПОБЕДИТЕЛЕЙ
+# ========================
+#
+# Победители выбираются по позициям билетов (0..n-1 в порядке покупки),
+# поэтому в памяти не нужно держать копию всех билетов.
+#
+# Розыгрыш воспроизводим: при создании генерируется секрет, а его хеш
+# (commitment) публикуется сразу. После завершения секрет раскрывается,
+# и любой может пересчитать победителей:
+#
+#   seed = sha256("<секрет>:<id розыгрыша>:<число билетов>")
+#   поток = sha256(seed || счетчик), счетчик = 0, 1, 2, ... (8 байт, big-endian)
+#   каждый блок режется на 4 числа по 8 байт; числа >= limit отбрасываются
+#   (limit = 2^64 - 2^64 mod n, чтобы не было смещения), позиция = x mod n
+#
+# Повторные позиции пропускаются. С one_prize_per_user пропускаются и
+# билеты уже выигравших пользователей.
+
+DRAW_ALGORITHM = "sha256-ctr-v1"
+
+def new_draw_secret():
+    """Секрет розыгрыша; раскрывается после завершения"""
+    return secrets.token_hex(16)
+
+def draw_commitment(secret):
+    """Хеш секрета, который публикуется до розыгрыша"""
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+def _draw_stream(seed, n):
+    limit = (1 << 64) - (1 << 64) % n
+    counter = 0
+    while True:
+        block = hashlib.sha256(seed + counter.to_bytes(8, 'big')).digest()
+        counter += 1
+        for i in range(0, 32, 8):
+            value = int.from_bytes(block[i:i + 8], 'big')
+            if value < limit:
+                yield value % n
+
+def draw_positions(secret, lottery_id, ticket_count, prize_count,
+                   owner=None, user_count=None, one_prize_per_user=False):
+    """Позиции выигравших билетов.
+
+    owner(position) возвращает владельца билета; нужен только для
+    one_prize_per_user, как и user_count — число разных участников.
+    """
+    if ticket_count <= 0 or prize_count <= 0:
+        return []
+    seed = hashlib.sha256(f"{secret}:{lottery_id}:{ticket_count}".encode('utf-8')).digest()
+    winners_needed = min(prize_count, ticket_count)
+    if one_prize_per_user:
+        winners_needed = min(winners_needed, user_count)
+
+    positions = []
+    taken = set()
+    users = set()
+    stream = _draw_stream(seed, ticket_count)
+    rejected = 0
+    while len(positions) < winners_needed:
+        position = next(stream)
+        if position in taken:
+            continue
+        if one_prize_per_user:
+            user = owner(position)
+            if user in users:
+                rejected += 1
+                if rejected > 64 * winners_needed + 1024:
+                    # Почти все билеты у уже выигравших: доигрываем по оставшимся
+                    return positions + _draw_remaining(seed, ticket_count, winners_needed - len(positions), owner, users)
+                continue
+            users.add(user)
+        taken.add(position)
+        positions.append(position)
+    return positions
+
+def _draw_remaining(seed, ticket_count, needed, owner, users):
+    """Запасной путь: один проход по билетам, дальше каждый приз
+    разыгрывается среди билетов еще не выигравших пользователей"""
+    remaining = {}
+    for position in range(ticket_count):
+        user = owner(position)
+        if user not in users:
+            remaining.setdefault(user, []).append(position)
+    positions = []
+    for prize in range(needed):
+        if not remaining:
+            break
+        total = sum(len(user_positions) for user_positions in remaining.values())
+        index = next(_draw_stream(seed + b"fallback" + prize.to_bytes(4, 'big'), total))
+        for user, user_positions in remaining.items():
+            if index < len(user_positions):
+                positions.append(user_positions[index])
+                del remaining[user]
+                break
+            index -= len(user_positions)
+    return positions
+
+def draw_lottery(lottery, users, one_prize_per_user=False):
+    """Разыгрываем призы; возвращаем (победители, данные для проверки).
+
+    users — профили пользователей: в билетах имен не хранится.
+    """
+    tickets = lottery["tickets"]
+    secret = lottery.get("draw_secret") or new_draw_secret()
+    positions = draw_positions(
+        secret,
+        lottery["id"],
+        len(tickets),
+        lottery["prize_count"],
+        owner=tickets.users.__getitem__,
+        user_count=len(tickets.members),
+        one_prize_per_user=one_prize_per_user
+    )
+    winners = []
+    for position in positions:
+        user_id = tickets.user_at(position)
+        profile = users.get(user_id, {})
+        winners.append({
+            "user_id": user_id,
+            "username": profile.get("username") or "без username",
+            "first_name": profile.get("first_name") or "Пользователь",
+            "ticket": tickets.numbers[position],
+            "position": position
+        })
+    draw = {
+        "algorithm": DRAW_ALGORITHM,
+        "secret": secret,
+        "commitment": draw_commitment(secret),
+        "ticket_count": len(tickets),
+        "one_prize_per_user": one_prize_per_user
+    }
+    return winners, draw
+
+def verify_draw(lottery):
+    """Пересчитываем победителей завершенного розыгрыша"""
+    draw = lottery["draw"]
+    if draw_commitment(draw["secret"]) != draw["commitment"]:
+        return False
+    tickets = lottery["tickets"]
+    positions = draw_positions(
+        draw["secret"],
+        lottery["id"],
+        draw["ticket_count"],
+        lottery["prize_count"],
+        owner=tickets.users.__getitem__,
+        user_count=len(tickets.members),
+        one_prize_per_user=draw["one_prize_per_user"]
+    )
+    return positions == [winner["position"] for winner in lottery["winners"]]
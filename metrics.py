@@ -0,0 +1,237 @@
+import contextlib
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import SkipHandler
+
+# ========================
+# 📈 МЕТРИКИ
+# ========================
+#
+# Небольшая реализация счетчиков, gauge и гистограмм в текстовом
+# формате Prometheus, чтобы не тянуть отдельную зависимость.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    """Значение задается напрямую или считается функцией при выдаче.
+
+    func возвращает число, если у метрики нет меток, и словарь
+    {кортеж меток: значение}, если есть.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self):
+        if self.func:
+            value = self.func()
+            self.values = value if self.labels else {(): value}
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _number(bound)),)
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+        return lines
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ========================
+# ⏱️ ОБРАБОТЧИКИ И ЗАПРОСЫ К TELEGRAM
+# ========================
+
+UPDATES_IN_FLIGHT = Gauge("lottery_updates_in_flight", "Апдейты, которые сейчас обрабатываются")
+HANDLER_SECONDS = Histogram("lottery_handler_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = Counter("lottery_handler_errors_total", "Исключения в обработчиках", ["handler"])
+TELEGRAM_SECONDS = Histogram("lottery_telegram_request_seconds", "Время запроса к Bot API", ["method"])
+TELEGRAM_ERRORS = Counter("lottery_telegram_request_errors_total", "Ошибки запросов к Bot API", ["method"])
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: сколько апдейтов в работе"""
+
+    async def __call__(self, handler, event, data):
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время и ошибки каждого обработчика"""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except SkipHandler:
+            # Обработчик передал апдейт следующему — это не ошибка
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого метода Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.inc(name)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+# ========================
+# 🚀 ЗАПУСК
+# ========================
+
+STARTUP_SECONDS = Gauge("lottery_startup_seconds", "Длительность фаз запуска", ["phase"])
+
+STARTUP_PHASES = {
+    "import": "импорт",
+    "load": "загрузка состояния",
+    "warm": "прогрев",
+    "ready": "до готовности",
+    "first_update": "первый апдейт",
+}
+
+class StartupTimer:
+    """Фазы запуска в секундах; started — perf_counter() в начале импорта"""
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = {}
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+        STARTUP_SECONDS.set(seconds, phase)
+
+    def mark(self, phase):
+        """Фаза, отсчитанная от начала импорта"""
+        self.record(phase, time.perf_counter() - self.started)
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - started)
+
+    def report(self):
+        return ", ".join(
+            f"{STARTUP_PHASES.get(phase, phase)} {seconds * 1000:.0f} мс"
+            for phase, seconds in self.phases.items()
+        )
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: время первого апдейта и отчет о запуске"""
+
+    def __init__(self, timer, log):
+        self.timer = timer
+        self.log = log
+        self.done = False
+
+    async def __call__(self, handler, event, data):
+        if self.done:
+            return await handler(event, data)
+        self.done = True
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timer.record("first_update", time.perf_counter() - started)
+            self.log(f"⏱️ Запуск: {self.timer.report()}")
@@ -0,0 +1,291 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+logger = logging.getLogger(__name__)
+
+# ========================
+# 📮 ОЧЕРЕДЬ ИСХОДЯЩИХ
+# ========================
+
+class TokenBucket:
+    """Не больше rate сообщений в секунду, всплеском до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """Через сколько секунд будет доступен токен"""
+        now = now or time.monotonic()
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        self._refill(now or time.monotonic())
+        self.tokens -= 1
+
+class Outbox:
+    """Очередь уведомлений с ограничением скорости.
+
+    Обработчики только ставят сообщения в очередь и не ждут отправки.
+    Отправка идет с общим лимитом и лимитом на каждый чат, на
+    TelegramRetryAfter чат откладывается на указанное время, сетевые
+    ошибки повторяются с растущей паузой. Неотправленные сообщения
+    сохраняются в файл и переживают перезапуск.
+    """
+
+    def __init__(self, bot, path, global_rate=25.0, chat_rate=1.0, workers=4,
+                 max_attempts=5, save_delay=1.0):
+        self.bot = bot
+        self.path = path
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.save_delay = save_delay
+
+        self.chats = {}          # chat_id -> список сообщений по порядку
+        self.buckets = {}        # chat_id -> TokenBucket
+        self.ready = []          # куча (когда можно слать, chat_id)
+        self.busy = set()        # чаты, в которые сейчас идет отправка
+        self.next_id = 1
+        self.sent = 0
+        self.failed = 0
+
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._save_task = None
+
+    def __len__(self):
+        return sum(len(messages) for messages in self.chats.values())
+
+    # ---- постановка в очередь ----
+
+    def send(self, chat_id, text):
+        """Ставим сообщение в очередь и сразу возвращаемся"""
+        self._push({"id": self.next_id, "chat_id": chat_id, "text": text, "attempts": 0})
+        self.next_id += 1
+        self._schedule_save()
+
+    def _push(self, message):
+        chat_id = message["chat_id"]
+        messages = self.chats.setdefault(chat_id, [])
+        messages.append(message)
+        if len(messages) == 1 and chat_id not in self.busy:
+            heapq.heappush(self.ready, (time.monotonic(), chat_id))
+            self._wakeup.set()
+
+    # ---- сохранение ----
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            logger.exception(f"❌ Не удалось прочитать очередь {self.path}")
+            return
+        for message in saved["messages"]:
+            self._push(message)
+        self.next_id = saved.get("next_id", self.next_id)
+        if saved["messages"]:
+            logger.info(f"📮 В очереди после перезапуска: {len(saved['messages'])} сообщений")
+
+    def _snapshot(self):
+        messages = [message for chat in self.chats.values() for message in chat]
+        messages.sort(key=lambda message: message["id"])
+        return json.dumps({"next_id": self.next_id, "messages": messages}, ensure_ascii=False)
+
+    def _write(self, payload):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def _schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.save_delay)
+        try:
+            await asyncio.to_thread(self._write, self._snapshot())
+        except Exception:
+            logger.exception("❌ Не удалось сохранить очередь сообщений")
+
+    # ---- отправка ----
+
+    async def _worker(self):
+        while True:
+            if not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            when, chat_id = self.ready[0]
+            wait = max(when - now, self.global_bucket.delay(now))
+            if wait > 0:
+                self._wakeup.clear()
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait([waiter], timeout=wait)
+                finally:
+                    waiter.cancel()
+                continue
+
+            heapq.heappop(self.ready)
+            self.global_bucket.take(now)
+            bucket = self.buckets.setdefault(chat_id, TokenBucket(self.chat_rate))
+            bucket.take(now)
+            self.busy.add(chat_id)
+            try:
+                retry_in = await self._deliver(self.chats[chat_id][0])
+            finally:
+                self.busy.discard(chat_id)
+
+            messages = self.chats[chat_id]
+            if retry_in is None:
+                messages.pop(0)
+                self._schedule_save()
+            if messages:
+                delay = retry_in if retry_in is not None else bucket.delay()
+                heapq.heappush(self.ready, (time.monotonic() + delay, chat_id))
+                self._wakeup.set()
+            else:
+                del self.chats[chat_id]
+                self.buckets.pop(chat_id, None)
+
+    async def _deliver(self, message):
+        """Отправляем сообщение; возвращаем паузу до повтора или None"""
+        try:
+            await self.bot.send_message(message["chat_id"], message["text"])
+            self.sent += 1
+            return None
+        except TelegramRetryAfter as e:
+            logger.warning(f"⏳ Лимит Telegram для {message['chat_id']}: ждем {e.retry_after} с")
+            return e.retry_after
+        except (TelegramNetworkError, TelegramServerError) as e:
+            message["attempts"] += 1
+            if message["attempts"] < self.max_attempts:
+                return min(60, 2 ** message["attempts"])
+            logger.error(f"❌ Сообщение в {message['chat_id']} не доставлено: {e}")
+        except TelegramAPIError as e:
+            # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+            logger.warning(f"⚠️ Сообщение в {message['chat_id']} отброшено: {e}")
+        self.failed += 1
+        return None
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливаем отправку и сохраняем то, что не успели отправить"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._save_task:
+            self._save_task.cancel()
+        await asyncio.to_thread(self._write, self._snapshot())
+
+# ========================
+# 🧾 СВОДКИ ПОКУПОК
+# ========================
+
+class PurchaseDigest:
+    """Копит покупки и раз в interval секунд шлет админу сводку по каждому
+    розыгрышу: число покупок, билетов, выручку и топ покупателей.
+
+    Покупки от alert_amount звезд дополнительно уходят отдельным
+    сообщением сразу. Все отправки идут через Outbox, поэтому покупатель
+    никогда не ждет сообщения админу.
+    """
+
+    def __init__(self, outbox, chat_id, interval=60.0, alert_amount=0, top=5):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.interval = interval
+        self.alert_amount = alert_amount
+        self.top = top
+        self.lotteries = {}
+        self._task = None
+
+    def add(self, lottery_id, buyer, tickets, amount):
+        """Учитываем покупку"""
+        stats = self.lotteries.setdefault(lottery_id, {
+            "purchases": 0, "tickets": 0, "revenue": 0, "buyers": {}
+        })
+        stats["purchases"] += 1
+        stats["tickets"] += tickets
+        stats["revenue"] += amount
+        buyer_stats = stats["buyers"].setdefault(buyer, [0, 0])
+        buyer_stats[0] += tickets
+        buyer_stats[1] += amount
+
+        if self.alert_amount and amount >= self.alert_amount:
+            self.outbox.send(
+                self.chat_id,
+                f"🚨 КРУПНАЯ ПОКУПКА!\n"
+                f"👤 {buyer}\n"
+                f"🎪 Розыгрыш: {lottery_id}\n"
+                f"🎫 Билетов: {tickets}\n"
+                f"💰 Сумма: {amount}⭐"
+            )
+
+    def flush(self):
+        """Отправляем накопленные сводки"""
+        lotteries, self.lotteries = self.lotteries, {}
+        minutes = max(1, round(self.interval / 60))
+        for lottery_id, stats in lotteries.items():
+            top = sorted(stats["buyers"].items(), key=lambda item: item[1][1], reverse=True)[:self.top]
+            top_lines = "\n".join(
+                f"{i}. {buyer} — {tickets} бил. / {amount}⭐"
+                for i, (buyer, (tickets, amount)) in enumerate(top, 1)
+            )
+            self.outbox.send(
+                self.chat_id,
+                f"🧾 <b>ПОКУПКИ ЗА {minutes} МИН</b>\n\n"
+                f"🎪 Розыгрыш: {lottery_id}\n"
+                f"🛒 Покупок: {stats['purchases']}\n"
+                f"🎫 Билетов: {stats['tickets']}\n"
+                f"💰 Выручка: {stats['revenue']}⭐\n"
+                f"👥 Покупателей: {len(stats['buyers'])}\n\n"
+                f"<b>🏆 Топ покупателей:</b>\n{top_lines}"
+            )
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливаем и отдаем в очередь то, что накопилось"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
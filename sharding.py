@@ -0,0 +1,328 @@
+import asyncio
+import functools
+import io
+import json
+import logging
+import os
+import struct
+
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+# ========================
+# 🧩 ШАРДИРОВАННЫЙ РЕЖИМ
+# ========================
+#
+# Процесс-владелец держит состояние и единственный пишет его на диск.
+# Он же получает апдейты от Telegram и раздает их N воркерам по хешу
+# user_id, поэтому все апдейты одного пользователя и его диалоги FSM
+# всегда попадают в один процесс.
+#
+# Воркер при подключении получает бинарный снимок состояния, а дальше —
+# все операции в порядке seq, и держит у себя реплику: чтения идут из
+# нее. Менять состояние воркер не может, он просит владельца выполнить
+# команду (покупка, создание и завершение розыгрыша). Владелец рассылает
+# получившиеся операции всем воркерам раньше, чем отвечает, поэтому к
+# ответу операция уже применена в реплике спросившего воркера.
+#
+# Кадр в локальном unix-сокете: тип (uint8), длина (uint32), данные.
+# JSON_FRAME — сообщение, SNAPSHOT_FRAME — снимок в формате snapshot.py.
+
+JSON_FRAME, SNAPSHOT_FRAME = 1, 2
+
+_FRAME = struct.Struct("<BI")
+
+def _frame(message):
+    payload = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return _FRAME.pack(JSON_FRAME, len(payload)) + payload
+
+async def read_frame(reader):
+    """Следующий кадр: (тип, bytes)"""
+    kind, length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return kind, await reader.readexactly(length)
+
+def shard_of(user_id, shards):
+    """Номер воркера для пользователя"""
+    return hash(user_id) % shards
+
+def update_user_id(update):
+    """Отправитель апдейта (словаря Bot API) или None"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user") or value.get("chat")
+        if user:
+            return user["id"]
+    return None
+
+class StateCommands:
+    """Реестр команд, меняющих состояние.
+
+    Декоратор регистрирует корутину под ее именем. Аргументы передаются
+    только по имени и должны переживать JSON, как и результат. Пока
+    client не задан, команда выполняется на месте, в воркере — уходит
+    владельцу состояния.
+    """
+
+    def __init__(self):
+        self.funcs = {}
+        self.client = None
+
+    def __call__(self, func):
+        name = func.__name__
+        self.funcs[name] = func
+
+        @functools.wraps(func)
+        async def command(**kwargs):
+            if self.client is not None:
+                return await self.client.request(name, kwargs)
+            return await func(**kwargs)
+        return command
+
+# ========================
+# 👑 ВЛАДЕЛЕЦ СОСТОЯНИЯ
+# ========================
+
+class StateOwner:
+    """Сервер команд, рассылка операций и раздача апдейтов воркерам.
+
+    argv — команда запуска воркера; номер воркера и путь к сокету он
+    получает в SHARD_INDEX и SHARD_SOCKET. Упавший воркер запускается
+    заново, апдейты для него ждут в очереди до переподключения.
+    errors — исключения команд, которые воркер получит тем же классом.
+    """
+
+    def __init__(self, store, commands, path, workers, argv, errors=()):
+        self.store = store
+        self.commands = commands
+        self.path = path
+        self.workers = workers
+        self.argv = list(argv)
+        self.errors = tuple(errors)
+        self.writers = {}                                    # номер воркера -> StreamWriter
+        self.backlog = {index: [] for index in range(workers)}
+        self.in_flight = {}                                  # update_id -> (номер воркера, future)
+        self.routed = [0] * workers
+        self.restarts = 0
+        self.stopping = False
+        self._server = None
+        self._watchers = []
+        self._tasks = set()
+        self._ready = asyncio.Event()
+
+    async def start(self, timeout=60):
+        """Запускаем воркеров и ждем, пока все получат снимок"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        self.store.listeners.append(self._broadcast)
+        for index in range(self.workers):
+            self._watchers.append(asyncio.create_task(self._supervise(index)))
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        logger.info(f"🧩 Воркеров запущено: {self.workers}")
+
+    async def _supervise(self, index):
+        env = {**os.environ, "SHARD_INDEX": str(index), "SHARD_SOCKET": self.path}
+        while True:
+            process = await asyncio.create_subprocess_exec(*self.argv, env=env)
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                try:
+                    await asyncio.wait_for(process.wait(), 10)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                raise
+            if self.stopping:
+                return
+            self.restarts += 1
+            logger.error(f"❌ Воркер {index} завершился с кодом {code}, перезапускаем")
+            await asyncio.sleep(1)
+
+    async def _serve(self, reader, writer):
+        index = None
+        try:
+            _, payload = await read_frame(reader)
+            index = json.loads(payload)["worker"]
+            # Снимок и подписка на операции без await между ними:
+            # ни одна операция не потеряется и не придет дважды
+            chunks = snapshot.encode(self.store.data)
+            writer.write(_FRAME.pack(SNAPSHOT_FRAME, sum(len(chunk) for chunk in chunks)))
+            writer.writelines(chunks)
+            writer.writelines(self.backlog[index])
+            self.backlog[index].clear()
+            self.writers[index] = writer
+            logger.info(f"🧩 Воркер {index} подключен (seq {self.store.data.get('seq', 0)})")
+            if len(self.writers) == self.workers:
+                self._ready.set()
+
+            while True:
+                _, payload = await read_frame(reader)
+                message = json.loads(payload)
+                if "cmd" in message:
+                    task = asyncio.create_task(self._execute(writer, message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                elif "done" in message:
+                    _, future = self.in_flight.pop(message["done"], (None, None))
+                    if future and not future.done():
+                        future.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if index is not None and self.writers.get(index) is writer:
+                del self.writers[index]
+                self._fail_in_flight(index)
+                if not self.stopping:
+                    logger.warning(f"⚠️ Воркер {index} отключился")
+            writer.close()
+
+    def _fail_in_flight(self, index):
+        """Апдейты отключившегося воркера считаются потерянными"""
+        for update_id, (shard, future) in list(self.in_flight.items()):
+            if shard == index:
+                del self.in_flight[update_id]
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Воркер {index} отключился"))
+
+    async def _execute(self, writer, message):
+        try:
+            result = await self.commands.funcs[message["cmd"]](**message["args"])
+            reply = {"id": message["id"], "result": result}
+        except self.errors as e:
+            reply = {"id": message["id"], "error": type(e).__name__, "message": str(e)}
+        except Exception as e:
+            logger.exception(f"❌ Ошибка команды {message['cmd']}")
+            reply = {"id": message["id"], "error": None, "message": repr(e)}
+        if not writer.is_closing():
+            writer.write(_frame(reply))
+
+    def _broadcast(self, op):
+        frame = _frame({"op": op})
+        for writer in self.writers.values():
+            writer.write(frame)
+
+    def route(self, update):
+        """Отдаем апдейт (словарь Bot API) воркеру его отправителя.
+
+        Возвращает future, который завершится, когда воркер обработает апдейт.
+        """
+        user_id = update_user_id(update)
+        index = 0 if user_id is None else shard_of(user_id, self.workers)
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[update["update_id"]] = (index, future)
+        self.routed[index] += 1
+        frame = _frame({"update": update})
+        writer = self.writers.get(index)
+        if writer is None:
+            self.backlog[index].append(frame)
+        else:
+            writer.write(frame)
+        return future
+
+    async def stop(self, timeout=10):
+        """Дожидаемся розданных апдейтов и останавливаем воркеров"""
+        self.stopping = True
+        pending = [future for _, future in self.in_flight.values()]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+        self.store.listeners.remove(self._broadcast)
+        # Закрытое соединение — сигнал воркеру завершиться
+        for writer in list(self.writers.values()):
+            writer.close()
+        for watcher in self._watchers:
+            watcher.cancel()
+        await asyncio.gather(*self._watchers, return_exceptions=True)
+        self._server.close()
+        await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        logger.info(f"🧩 Воркеры остановлены, апдейтов роздано: {sum(self.routed)}")
+
+# ========================
+# 🛠️ ВОРКЕР
+# ========================
+
+class ShardClient:
+    """Реплика состояния, команды владельцу и входящие апдейты воркера"""
+
+    def __init__(self, store, path, index, on_update, errors=()):
+        self.store = store
+        self.path = path
+        self.index = index
+        self.on_update = on_update
+        self.errors = {cls.__name__: cls for cls in errors}
+        self.requests = {}
+        self._next_id = 0
+        self._tasks = set()
+        self.reader = self.writer = None
+
+    async def connect(self):
+        """Подключаемся к владельцу и загружаем реплику из снимка"""
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(_frame({"worker": self.index}))
+        kind, payload = await read_frame(self.reader)
+        if kind != SNAPSHOT_FRAME:
+            raise ConnectionError("Владелец не прислал снимок состояния")
+        self.store.load_replica(snapshot.read(io.BytesIO(payload)))
+        logger.info(
+            f"🧩 Воркер {self.index}: реплика загружена "
+            f"(seq {self.store.data.get('seq', 0)}, {len(self.store.data['users'])} пользователей)"
+        )
+
+    async def request(self, name, kwargs):
+        """Выполняем команду у владельца"""
+        if self.writer.is_closing():
+            raise ConnectionError("Владелец состояния недоступен")
+        self._next_id += 1
+        future = self.requests[self._next_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(_frame({"cmd": name, "args": kwargs, "id": self._next_id}))
+        return await future
+
+    def _reply(self, message):
+        future = self.requests.pop(message["id"], None)
+        if future is None or future.done():
+            return
+        if "error" not in message:
+            future.set_result(message["result"])
+        else:
+            error = self.errors.get(message["error"], RuntimeError)
+            future.set_exception(error(message["message"]))
+
+    async def run(self):
+        """Работаем, пока владелец не закроет соединение"""
+        try:
+            while True:
+                _, payload = await read_frame(self.reader)
+                message = json.loads(payload)
+                if "op" in message:
+                    self.store.replicate(message["op"])
+                elif "update" in message:
+                    task = asyncio.create_task(self._process(message["update"]))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                else:
+                    self._reply(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info(f"🔌 Воркер {self.index}: владелец закрыл соединение")
+        finally:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Владелец состояния недоступен"))
+            self.requests.clear()
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+            self.writer.close()
+
+    async def _process(self, update):
+        try:
+            await self.on_update(update)
+        except Exception:
+            logger.exception(f"❌ Воркер {self.index}: ошибка обработки апдейта {update['update_id']}")
+        finally:
+            if not self.writer.is_closing():
+                self.writer.write(_frame({"done": update["update_id"]}))
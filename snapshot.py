@@ -0,0 +1,179 @@
+"""Бинарный снимок состояния.
+
+Запуск конвертера:
+    python snapshot.py to-json lottery_state.snap lottery_data.json
+    python snapshot.py from-json lottery_data.json lottery_state.snap
+"""
+import argparse
+import json
+import struct
+import sys
+from array import array
+
+from tickets import TicketTable
+
+# ========================
+# 💽 ФОРМАТ СНИМКА
+# ========================
+#
+# Файл — заголовок и последовательность записей с длиной:
+#
+#   заголовок: MAGIC, версия схемы (uint16)
+#   запись:    тип (uint8), длина (uint32), данные
+#
+# META     — JSON верхнего уровня (seq и т.п.), первая запись
+# USERS    — JSON-словарь пачки пользователей
+# LOTTERY  — JSON розыгрыша без билетов + раздел
+# TICKETS  — билеты последнего LOTTERY: длина JSON участников (uint32),
+#            JSON участников, затем колонки numbers (int64),
+#            users (uint32) и times (int64) как есть, little-endian
+# END      — конец снимка; без нее файл считается недописанным
+#
+# Записи читаются по одной, поэтому при загрузке в памяти не бывает
+# второй полной копии состояния.
+
+MAGIC = b"LOTSNAP\0"
+SCHEMA_VERSION = 1
+
+META, USERS, LOTTERY, TICKETS, END = 1, 2, 3, 4, 5
+
+USERS_PER_RECORD = 10000
+
+_HEADER = struct.Struct("<8sH")
+_RECORD = struct.Struct("<BI")
+_U32 = struct.Struct("<I")
+
+# Миграции схемы: версия -> функция, поднимающая данные до версии + 1
+MIGRATIONS = {}
+
+class SnapshotError(ValueError):
+    pass
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _column(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _record(kind, *parts):
+    return [_RECORD.pack(kind, sum(len(part) for part in parts)), *parts]
+
+def encode(data):
+    """Снимок списком кусков bytes; готовится в цикле событий"""
+    chunks = [_HEADER.pack(MAGIC, SCHEMA_VERSION)]
+    meta = {k: v for k, v in data.items() if k not in ("users", "active_lotteries", "ended_lotteries")}
+    chunks += _record(META, _json(meta))
+
+    users = list(data["users"].items())
+    for start in range(0, len(users), USERS_PER_RECORD):
+        chunks += _record(USERS, _json(dict(users[start:start + USERS_PER_RECORD])))
+
+    for section in ("active_lotteries", "ended_lotteries"):
+        for lottery in data[section].values():
+            table = lottery.get("tickets")
+            header = {k: v for k, v in lottery.items() if k != "tickets"}
+            chunks += _record(LOTTERY, _json({"section": section, "lottery": header}))
+            if table is not None:
+                members = _json(table.members)
+                chunks += _record(
+                    TICKETS, _U32.pack(len(members)), members,
+                    _column(table.numbers), _column(table.users), _column(table.times)
+                )
+
+    chunks += _record(END)
+    return chunks
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError("Снимок оборван")
+    return data
+
+def records(f):
+    """Записи снимка по одной: (тип, bytes)"""
+    magic, version = _HEADER.unpack(_read_exact(f, _HEADER.size))
+    if magic != MAGIC:
+        raise SnapshotError("Это не снимок состояния")
+    if version > SCHEMA_VERSION:
+        raise SnapshotError(f"Снимок новее программы: схема {version}, поддерживается {SCHEMA_VERSION}")
+    yield None, version
+    while True:
+        kind, length = _RECORD.unpack(_read_exact(f, _RECORD.size))
+        if kind == END:
+            return
+        yield kind, _read_exact(f, length)
+
+def _columns(payload):
+    members_size = _U32.unpack_from(payload)[0]
+    offset = _U32.size + members_size
+    members = json.loads(payload[_U32.size:offset])
+    count = (len(payload) - offset) // 20
+    numbers, users, times = array('q'), array('I'), array('q')
+    for column in (numbers, users, times):
+        size = column.itemsize * count
+        column.frombytes(payload[offset:offset + size])
+        offset += size
+        if sys.byteorder != "little":
+            column.byteswap()
+    return TicketTable.from_columns(members, numbers, users, times)
+
+def read(f):
+    """Читаем снимок из файла, открытого в режиме 'rb'"""
+    data = {"users": {}, "active_lotteries": {}, "ended_lotteries": {}, "payments": {}}
+    stream = records(f)
+    _, version = next(stream)
+    lottery = None
+    for kind, payload in stream:
+        if kind == META:
+            data.update(json.loads(payload))
+        elif kind == USERS:
+            data["users"].update(json.loads(payload))
+        elif kind == LOTTERY:
+            record = json.loads(payload)
+            lottery = record["lottery"]
+            if not lottery.get("archived"):
+                lottery["tickets"] = TicketTable()
+            data[record["section"]][lottery["id"]] = lottery
+        elif kind == TICKETS:
+            lottery["tickets"] = _columns(payload)
+        # Неизвестные записи пропускаем: их могла добавить новая версия
+        # без смены схемы
+    while version < SCHEMA_VERSION:
+        data = MIGRATIONS[version](data)
+        version += 1
+    return data
+
+def load(path):
+    with open(path, 'rb') as f:
+        return read(f)
+
+def write(path, chunks):
+    with open(path, 'wb') as f:
+        f.writelines(chunks)
+
+# ========================
+# 🔄 КОНВЕРТЕР JSON
+# ========================
+
+def main():
+    from storage import encode_state, read_json_state
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("to-json", "from-json"))
+    parser.add_argument("source")
+    parser.add_argument("target")
+    args = parser.parse_args()
+
+    if args.command == "to-json":
+        data = load(args.source)
+        with open(args.target, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'), default=encode_state)
+    else:
+        write(args.target, encode(read_json_state(args.source)))
+    print(f"✅ {args.source} -> {args.target}")
+
+if __name__ == "__main__":
+    main()
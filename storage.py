@@ -0,0 +1,1121 @@
+import asyncio
+import bisect
+import contextlib
+import copy
+import gzip
+import json
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime
+
+import snapshot
+from ledger import ledger_entries
+from metrics import Histogram
+from tickets import TicketTable, purchase_epoch
+
+logger = logging.getLogger(__name__)
+
+STORAGE_SECONDS = Histogram("lottery_storage_seconds", "Время операций хранилища состояния", ["operation"])
+
+# ========================
+# 📦 СОСТОЯНИЕ В ПАМЯТИ
+# ========================
+
+def empty_state():
+    """Пустое состояние бота"""
+    return {"active_lotteries": {}, "ended_lotteries": {}, "users": {}, "payments": {}}
+
+def encode_state(value):
+    """default для json.dumps: таблицы билетов пишутся колонками"""
+    if isinstance(value, TicketTable):
+        return value.to_json()
+    raise TypeError(f"Не сериализуется: {type(value).__name__}")
+
+def restore_tickets(lottery):
+    """Таблица билетов из прочитанного JSON (старые файлы — списком словарей)"""
+    if not lottery.get("archived"):
+        lottery.pop("participants", None)
+        lottery["tickets"] = TicketTable.from_json(lottery.get("tickets", []))
+    return lottery
+
+def decode_state(data):
+    data.setdefault("payments", {})
+    for section in ("active_lotteries", "ended_lotteries"):
+        for lottery in data[section].values():
+            restore_tickets(lottery)
+    return data
+
+def apply_op(data, op):
+    """Применяем одну операцию к состоянию.
+
+    Все изменения состояния проходят через эту функцию, поэтому
+    одна и та же операция одинаково применяется в памяти и при записи.
+    """
+    kind = op["op"]
+
+    if kind == "register":
+        data["users"][op["user_id"]] = {
+            "balance": 0,
+            "total_spent": 0,
+            "total_tickets": 0,
+            "username": op["username"],
+            "first_name": op["first_name"],
+            "registered_at": op["registered_at"]
+        }
+
+    elif kind == "deposit":
+        data["users"][op["user_id"]]["balance"] += op["amount"]
+        data.setdefault("payments", {})[op["charge_id"]] = {"user_id": op["user_id"], "amount": op["amount"]}
+
+    elif kind == "create_lottery":
+        # Копия, чтобы операция в очереди на запись не менялась вместе с состоянием
+        lottery = restore_tickets(copy.deepcopy(op["lottery"]))
+        data["active_lotteries"][lottery["id"]] = lottery
+
+    elif kind == "purchase":
+        user = data["users"][op["user_id"]]
+        lottery = data["active_lotteries"][op["lottery_id"]]
+        count = len(op["tickets"])
+        cost = op["price"] * count
+
+        user["balance"] -= cost
+        user["total_spent"] += cost
+        user["total_tickets"] += count
+
+        lottery["tickets"].append(op["user_id"], op["tickets"], purchase_epoch(op["purchased_at"]))
+        lottery["sold_tickets"] += count
+
+    elif kind == "close_lottery":
+        lottery = data["active_lotteries"].pop(op["lottery_id"])
+        lottery["ended_at"] = op["ended_at"]
+        lottery["is_active"] = False
+        lottery["winners"] = op["winners"]
+        if "draw" in op:
+            lottery["draw"] = op["draw"]
+        data["ended_lotteries"][op["lottery_id"]] = lottery
+
+    elif kind == "archive_lottery":
+        # Полная версия уже лежит в архиве, в состоянии остается сводка
+        lottery = data["ended_lotteries"][op["lottery_id"]]
+        data["ended_lotteries"][op["lottery_id"]] = summarize_lottery(lottery)
+
+    else:
+        raise ValueError(f"Неизвестная операция: {kind}")
+
+    if "seq" in op:
+        data["seq"] = op["seq"]
+
+def summarize_lottery(lottery):
+    """Сводка завершенного розыгрыша для горячего состояния.
+
+    Без билетов и номеров: только число билетов у каждого участника,
+    чтобы работали «Мои билеты» и статистика.
+    """
+    if lottery.get("archived"):
+        return lottery
+    summary = {k: v for k, v in lottery.items() if k != "tickets"}
+    summary["ticket_counts"] = lottery["tickets"].ticket_counts()
+    summary["archived"] = True
+    return summary
+
+def lottery_users(lottery):
+    """Участники розыгрыша (user_id -> ...): полного или из архива"""
+    return lottery["ticket_counts"] if lottery.get("archived") else lottery["tickets"].member_index
+
+# ========================
+# 📈 СЧЕТЧИКИ
+# ========================
+
+class Aggregates:
+    """Итоговые счетчики для статистики.
+
+    Пересчитываются целиком только при загрузке, дальше каждая
+    операция обновляет их за O(1).
+    """
+
+    FIELDS = (
+        "total_users", "total_balance", "total_spent", "total_deposited",
+        "tickets_sold", "active_lotteries", "ended_lotteries"
+    )
+
+    def __init__(self):
+        self.total_users = 0
+        self.total_balance = 0
+        self.total_spent = 0
+        self.total_deposited = 0
+        self.tickets_sold = 0
+        self.active_lotteries = 0
+        self.ended_lotteries = 0
+        self.revenue = {}
+
+    @classmethod
+    def from_state(cls, data):
+        """Считаем все с нуля"""
+        aggregates = cls()
+        users = data["users"].values()
+        aggregates.total_users = len(data["users"])
+        aggregates.total_balance = sum(user["balance"] for user in users)
+        aggregates.total_spent = sum(user["total_spent"] for user in users)
+        aggregates.total_deposited = sum(payment["amount"] for payment in data.get("payments", {}).values())
+        aggregates.active_lotteries = len(data["active_lotteries"])
+        aggregates.ended_lotteries = len(data["ended_lotteries"])
+        for section in ("active_lotteries", "ended_lotteries"):
+            for lottery_id, lottery in data[section].items():
+                aggregates.tickets_sold += lottery["sold_tickets"]
+                aggregates.revenue[lottery_id] = lottery["sold_tickets"] * lottery["ticket_price"]
+        return aggregates
+
+    def apply(self, data, op):
+        """Учитываем операцию, уже примененную к состоянию"""
+        kind = op["op"]
+        if kind == "register":
+            self.total_users += 1
+        elif kind == "deposit":
+            self.total_balance += op["amount"]
+            self.total_deposited += op["amount"]
+        elif kind == "create_lottery":
+            self.active_lotteries += 1
+            self.revenue[op["lottery"]["id"]] = 0
+        elif kind == "purchase":
+            count = len(op["tickets"])
+            cost = op["price"] * count
+            self.total_balance -= cost
+            self.total_spent += cost
+            self.tickets_sold += count
+            self.revenue[op["lottery_id"]] = self.revenue.get(op["lottery_id"], 0) + cost
+        elif kind == "close_lottery":
+            self.active_lotteries -= 1
+            self.ended_lotteries += 1
+        elif kind == "archive_lottery":
+            # Сводка сохраняет цену и число проданных билетов
+            pass
+        else:
+            # Операция без своего правила: надежнее пересчитать
+            self.__dict__.update(Aggregates.from_state(data).__dict__)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def diff(self, other):
+        """Расхождения с другими счетчиками: {поле: (наше, их)}"""
+        mismatches = {
+            field: (getattr(self, field), getattr(other, field))
+            for field in self.FIELDS
+            if getattr(self, field) != getattr(other, field)
+        }
+        for lottery_id in self.revenue.keys() | other.revenue.keys():
+            ours, theirs = self.revenue.get(lottery_id, 0), other.revenue.get(lottery_id, 0)
+            if ours != theirs:
+                mismatches[f"revenue:{lottery_id}"] = (ours, theirs)
+        return mismatches
+
+# ========================
+# 🗄️ ХРАНИЛИЩА
+# ========================
+
+def read_json_state(path):
+    """Читаем состояние из JSON-файла.
+
+    Битый файл — это ошибка: пустое состояние при следующей записи
+    затерло бы все данные.
+    """
+    if not os.path.exists(path):
+        return empty_state()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        logger.exception(f"❌ Не удалось прочитать {path}")
+        raise
+    return decode_state(data)
+
+class JsonBackend:
+    """Все состояние одним JSON-файлом"""
+
+    group_commit = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        return read_json_state(self.path)
+
+    def prepare(self, data, ops):
+        """Готовим запись в цикле событий, пока состояние не меняется"""
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=encode_state)
+
+    def write(self, payload):
+        """Пишем в отдельном потоке"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    total_spent INTEGER NOT NULL DEFAULT 0,
+    total_tickets INTEGER NOT NULL DEFAULT 0,
+    username TEXT,
+    first_name TEXT,
+    registered_at TEXT
+);
+CREATE TABLE IF NOT EXISTS lotteries (
+    lottery_id TEXT PRIMARY KEY,
+    prize_count INTEGER NOT NULL,
+    ticket_price INTEGER NOT NULL,
+    duration_seconds INTEGER,
+    lottery_text TEXT,
+    created_at TEXT,
+    ends_at TEXT,
+    ended_at TEXT,
+    sold_tickets INTEGER NOT NULL DEFAULT 0,
+    is_active INTEGER NOT NULL DEFAULT 1,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS lotteries_active ON lotteries (is_active, ends_at);
+CREATE TABLE IF NOT EXISTS tickets (
+    lottery_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    purchased_at TEXT
+);
+CREATE INDEX IF NOT EXISTS tickets_lottery ON tickets (lottery_id);
+CREATE INDEX IF NOT EXISTS tickets_user ON tickets (user_id, lottery_id);
+CREATE TABLE IF NOT EXISTS winners (
+    lottery_id TEXT NOT NULL,
+    place INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    ticket INTEGER,
+    position INTEGER,
+    PRIMARY KEY (lottery_id, place)
+);
+CREATE TABLE IF NOT EXISTS payments (
+    charge_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    paid_at TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+LOTTERY_COLUMNS = (
+    "prize_count", "ticket_price", "duration_seconds", "lottery_text",
+    "created_at", "ends_at", "ended_at", "sold_tickets", "is_active"
+)
+
+class SqliteBackend:
+    """SQLite: пользователи, розыгрыши, билеты и победители в отдельных таблицах.
+
+    Вместо перезаписи всего состояния каждая операция превращается
+    в несколько точечных INSERT/UPDATE.
+    """
+
+    group_commit = False
+
+    def __init__(self, path, import_from=None):
+        self.path = path
+        self.import_from = import_from
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Добавляем колонки, появившиеся после создания базы"""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(winners)")}
+        if "position" not in columns:
+            self.conn.execute("ALTER TABLE winners ADD COLUMN position INTEGER")
+
+    def load(self):
+        empty = not self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() \
+            and not self.conn.execute("SELECT 1 FROM lotteries LIMIT 1").fetchone()
+        if empty and self.import_from and os.path.exists(self.import_from):
+            self.import_json(self.import_from)
+
+        data = empty_state()
+        for row in self.conn.execute(
+            "SELECT user_id, balance, total_spent, total_tickets, username, first_name, registered_at FROM users"
+        ):
+            data["users"][row[0]] = {
+                "balance": row[1],
+                "total_spent": row[2],
+                "total_tickets": row[3],
+                "username": row[4],
+                "first_name": row[5],
+                "registered_at": row[6]
+            }
+
+        lotteries = {}
+        for row in self.conn.execute(
+            f"SELECT lottery_id, {', '.join(LOTTERY_COLUMNS)}, extra FROM lotteries"
+        ):
+            lottery = {"id": row[0], **json.loads(row[-1] or "{}")}
+            lottery.update(zip(LOTTERY_COLUMNS, row[1:-1]))
+            if lottery["ended_at"] is None:
+                del lottery["ended_at"]
+            lottery["is_active"] = bool(lottery["is_active"])
+            if not lottery.get("archived"):
+                lottery["tickets"] = TicketTable()
+            lotteries[row[0]] = lottery
+            section = "active_lotteries" if lottery["is_active"] else "ended_lotteries"
+            data[section][row[0]] = lottery
+
+        for lottery_id, number, user_id, purchased_at in self.conn.execute(
+            "SELECT lottery_id, number, user_id, purchased_at FROM tickets ORDER BY rowid"
+        ):
+            lotteries[lottery_id]["tickets"].append(user_id, (number,), purchase_epoch(purchased_at))
+
+        for lottery_id, user_id, username, first_name, ticket, position in self.conn.execute(
+            "SELECT lottery_id, user_id, username, first_name, ticket, position FROM winners "
+            "ORDER BY lottery_id, place"
+        ):
+            winner = {
+                "user_id": user_id,
+                "username": username,
+                "first_name": first_name,
+                "ticket": ticket
+            }
+            if position is not None:
+                winner["position"] = position
+            lotteries[lottery_id].setdefault("winners", []).append(winner)
+        for lottery in data["ended_lotteries"].values():
+            lottery.setdefault("winners", [])
+
+        for charge_id, user_id, amount in self.conn.execute("SELECT charge_id, user_id, amount FROM payments"):
+            data["payments"][charge_id] = {"user_id": user_id, "amount": amount}
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+        if row:
+            data["seq"] = int(row[0])
+
+        return data
+
+    def import_json(self, path):
+        """Разовый перенос данных из lottery_data.json"""
+        data = read_json_state(path)
+        statements = []
+        for user_id, user in data["users"].items():
+            statements.append(self._user_row(user_id, user))
+        for section in ("active_lotteries", "ended_lotteries"):
+            for lottery in data[section].values():
+                statements.extend(self._lottery_rows(lottery))
+        statements.append((
+            "INSERT OR REPLACE INTO payments (charge_id, user_id, amount) VALUES (?, ?, ?)",
+            [(charge_id, payment["user_id"], payment["amount"]) for charge_id, payment in data["payments"].items()]
+        ))
+        statements.append(self._seq_row(data.get("seq", 0)))
+        with self.conn:
+            self._execute(statements)
+        logger.info(
+            f"📥 Импортировано из {path}: {len(data['users'])} пользователей, "
+            f"{len(data['active_lotteries']) + len(data['ended_lotteries'])} розыгрышей"
+        )
+
+    @staticmethod
+    def _user_row(user_id, user):
+        return (
+            "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(user_id, user["balance"], user["total_spent"], user["total_tickets"],
+              user.get("username"), user.get("first_name"), user.get("registered_at"))]
+        )
+
+    @staticmethod
+    def _seq_row(seq):
+        return ("INSERT OR REPLACE INTO meta VALUES ('seq', ?)", [(str(seq),)])
+
+    @staticmethod
+    def _ticket_rows(lottery_id, tickets):
+        """tickets: (номер, user_id, время покупки); имена берутся из users"""
+        return (
+            "INSERT INTO tickets (lottery_id, number, user_id, purchased_at) VALUES (?, ?, ?, ?)",
+            [(lottery_id, number, user_id, purchased_at) for number, user_id, purchased_at in tickets]
+        )
+
+    @staticmethod
+    def _winner_rows(lottery_id, winners):
+        return (
+            "INSERT OR REPLACE INTO winners VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(lottery_id, place, w["user_id"], w.get("username"), w.get("first_name"), w.get("ticket"),
+              w.get("position"))
+             for place, w in enumerate(winners, 1)]
+        )
+
+    @classmethod
+    def _lottery_rows(cls, lottery):
+        known = {"id", "tickets", "winners", *LOTTERY_COLUMNS}
+        extra = {k: v for k, v in lottery.items() if k not in known}
+        row = (lottery["id"], *(lottery.get(c) for c in LOTTERY_COLUMNS), json.dumps(extra, ensure_ascii=False))
+        row = list(row)
+        row[LOTTERY_COLUMNS.index("is_active") + 1] = int(lottery.get("is_active", True))
+        statements = [(
+            f"INSERT OR REPLACE INTO lotteries VALUES ({', '.join('?' * (len(LOTTERY_COLUMNS) + 2))})",
+            [tuple(row)]
+        )]
+        table = lottery.get("tickets")
+        if table:
+            statements.append(cls._ticket_rows(lottery["id"], (
+                (number, table.user_at(position), datetime.fromtimestamp(table.times[position]).isoformat())
+                for position, number in enumerate(table.numbers)
+            )))
+        if lottery.get("winners"):
+            statements.append(cls._winner_rows(lottery["id"], lottery["winners"]))
+        return statements
+
+    def prepare(self, data, ops):
+        """Переводим операции в SQL-запросы: [(seq, запросы операции)]"""
+        batch = []
+        for op in ops:
+            statements = []
+            batch.append((op.get("seq"), statements))
+            kind = op["op"]
+            if kind == "register":
+                statements.append(self._user_row(op["user_id"], {
+                    "balance": 0,
+                    "total_spent": 0,
+                    "total_tickets": 0,
+                    "username": op["username"],
+                    "first_name": op["first_name"],
+                    "registered_at": op["registered_at"]
+                }))
+            elif kind == "deposit":
+                statements.append((
+                    "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+                    [(op["amount"], op["user_id"])]
+                ))
+                statements.append((
+                    "INSERT INTO payments VALUES (?, ?, ?, ?)",
+                    [(op["charge_id"], op["user_id"], op["amount"], op["paid_at"])]
+                ))
+            elif kind == "create_lottery":
+                statements.extend(self._lottery_rows(op["lottery"]))
+            elif kind == "purchase":
+                count = len(op["tickets"])
+                cost = op["price"] * count
+                statements.append((
+                    "UPDATE users SET balance = balance - ?, total_spent = total_spent + ?, "
+                    "total_tickets = total_tickets + ? WHERE user_id = ?",
+                    [(cost, cost, count, op["user_id"])]
+                ))
+                statements.append(self._ticket_rows(op["lottery_id"], [
+                    (number, op["user_id"], op["purchased_at"]) for number in op["tickets"]
+                ]))
+                statements.append((
+                    "UPDATE lotteries SET sold_tickets = sold_tickets + ? WHERE lottery_id = ?",
+                    [(count, op["lottery_id"])]
+                ))
+            elif kind == "close_lottery":
+                statements.append((
+                    "UPDATE lotteries SET is_active = 0, ended_at = ? WHERE lottery_id = ?",
+                    [(op["ended_at"], op["lottery_id"])]
+                ))
+                if op["winners"]:
+                    statements.append(self._winner_rows(op["lottery_id"], op["winners"]))
+                if "draw" in op:
+                    statements.append((
+                        "UPDATE lotteries SET extra = json_set(coalesce(extra, '{}'), '$.draw', json(?)) "
+                        "WHERE lottery_id = ?",
+                        [(json.dumps(op["draw"], ensure_ascii=False), op["lottery_id"])]
+                    ))
+            elif kind == "archive_lottery":
+                summary = data["ended_lotteries"][op["lottery_id"]]
+                statements.append(("DELETE FROM tickets WHERE lottery_id = ?", [(op["lottery_id"],)]))
+                statements.append((
+                    "UPDATE lotteries SET extra = json_set(coalesce(extra, '{}'), "
+                    "'$.archived', json('true'), '$.ticket_counts', json(?)) WHERE lottery_id = ?",
+                    [(json.dumps(summary["ticket_counts"], ensure_ascii=False), op["lottery_id"])]
+                ))
+            else:
+                raise ValueError(f"Неизвестная операция: {kind}")
+        return batch
+
+    def write(self, batch):
+        """Все операции пачки одной транзакцией.
+
+        Запросы операций относительные (balance = balance - ?, новые
+        билеты), поэтому операции с seq не новее записанного в meta
+        пропускаются: повтор той же пачки не спишет деньги дважды.
+        """
+        with self.conn:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+            written = int(row[0]) if row else 0
+            last = None
+            for seq, statements in batch:
+                if seq is not None:
+                    if seq <= written:
+                        continue
+                    last = seq
+                self._execute(statements)
+            if last is not None:
+                self._execute([self._seq_row(last)])
+
+    def _execute(self, statements):
+        for sql, rows in statements:
+            self.conn.executemany(sql, rows)
+
+    def close(self):
+        self.conn.close()
+
+class JournalBackend:
+    """Бинарный снимок состояния + журнал операций.
+
+    Каждая операция дописывается строкой в журнал; все операции,
+    накопившиеся за время одного fsync, уходят следующим общим fsync
+    (group commit). Компактор периодически сворачивает журнал в новый
+    снимок, который подменяется атомарным rename. При старте читается
+    снимок и поверх него проигрываются операции с seq больше снимка.
+
+    Если снимка еще нет, состояние берется из legacy_json — прежнего
+    JSON-снимка; бинарный снимок появится при первом сворачивании.
+    """
+
+    group_commit = True
+
+    def __init__(self, snapshot_path, journal_path, compact_ops=10000, legacy_json=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.legacy_json = legacy_json
+        self.compact_ops = compact_ops
+        self.journal_ops = 0
+        self.file = None
+
+    def _load_snapshot(self):
+        if os.path.exists(self.snapshot_path):
+            try:
+                return snapshot.load(self.snapshot_path)
+            except (OSError, ValueError):
+                logger.exception(f"❌ Не удалось прочитать {self.snapshot_path}")
+                raise
+        if self.legacy_json:
+            return read_json_state(self.legacy_json)
+        return empty_state()
+
+    def load(self):
+        data = self._load_snapshot()
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                lines = f.read().split(b"\n")
+            offset = 0
+            for index, line in enumerate(lines):
+                if not line:
+                    offset += 1
+                    continue
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    if index == len(lines) - 1:
+                        # Оборванная последняя запись: операция не была подтверждена
+                        logger.warning(f"⚠️ Обрезаю недописанную запись журнала ({len(line)} байт)")
+                        with open(self.journal_path, 'r+b') as f:
+                            f.truncate(offset)
+                        break
+                    raise
+                offset += len(line) + 1
+                self.journal_ops += 1
+                if op["seq"] > data.get("seq", 0):
+                    apply_op(data, op)
+                    replayed += 1
+        logger.info(f"📜 Из журнала восстановлено операций: {replayed}")
+        self.file = open(self.journal_path, 'ab')
+        return data
+
+    def prepare(self, data, ops):
+        return b"".join(
+            json.dumps(op, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n"
+            for op in ops
+        )
+
+    def write(self, payload):
+        self.file.write(payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.journal_ops += payload.count(b"\n")
+
+    @property
+    def should_compact(self):
+        return self.journal_ops >= self.compact_ops
+
+    def snapshot(self, data):
+        """Готовим снимок в цикле событий"""
+        return snapshot.encode(data)
+
+    def compact(self, payload):
+        """Пишем снимок и начинаем журнал заново"""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.writelines(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Если упадем здесь, старые записи отсеются по seq при загрузке
+        self.file.close()
+        self.file = open(self.journal_path, 'wb')
+        os.fsync(self.file.fileno())
+        self.journal_ops = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def create_backend(kind, json_path, sqlite_path, journal_path, snapshot_path):
+    """Выбираем хранилище по имени"""
+    if kind == "json":
+        return JsonBackend(json_path)
+    if kind == "sqlite":
+        return SqliteBackend(sqlite_path, import_from=json_path)
+    if kind == "journal":
+        return JournalBackend(snapshot_path, journal_path, legacy_json=json_path)
+    raise ValueError(f"Неизвестное хранилище: {kind}")
+
+# ========================
+# 🗃️ АРХИВ ЗАВЕРШЕННЫХ
+# ========================
+
+class LotteryArchive:
+    """Завершенные розыгрыши целиком, каждый в своем файле .json.gz.
+
+    В горячем состоянии от них остается только сводка, полные данные
+    читаются по запросу и держатся в небольшом LRU-кэше.
+    """
+
+    def __init__(self, directory, cache_size=8):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, lottery_id):
+        return os.path.join(self.directory, f"{lottery_id}.json.gz")
+
+    def write(self, lottery):
+        """Пишем в отдельном потоке: tmp, fsync, rename"""
+        path = self.path(lottery["id"])
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6, mtime=0) as gz:
+                gz.write(json.dumps(
+                    lottery, ensure_ascii=False, separators=(',', ':'), default=encode_state
+                ).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def read(self, lottery_id):
+        with gzip.open(self.path(lottery_id), 'rb') as f:
+            return restore_tickets(json.loads(f.read()))
+
+    async def load(self, lottery_id):
+        """Полный розыгрыш из архива"""
+        lottery = self.cache.get(lottery_id)
+        if lottery is None:
+            lottery = await asyncio.to_thread(self.read, lottery_id)
+            self.cache[lottery_id] = lottery
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(lottery_id)
+        return lottery
+
+class UserTicketIndex:
+    """Обратный индекс: пользователь -> розыгрыши, где у него есть билеты.
+
+    У каждого пользователя — отсортированный список ключей (created_at,
+    ID) розыгрышей, включая завершенные. Порядок один и тот же после
+    загрузки и во время работы, а страницы «Моих билетов» отсчитываются
+    от ключа розыгрыша на краю предыдущей страницы, поэтому новая покупка
+    не сдвигает уже открытые страницы.
+    """
+
+    def __init__(self):
+        self.lotteries = {}
+
+    @staticmethod
+    def key(lottery):
+        return (lottery.get("created_at") or "", lottery["id"])
+
+    @classmethod
+    def from_state(cls, data):
+        index = cls()
+        lotteries = [*data["ended_lotteries"].values(), *data["active_lotteries"].values()]
+        lotteries.sort(key=cls.key)
+        for lottery in lotteries:
+            for user_id in lottery_users(lottery):
+                index.lotteries.setdefault(user_id, []).append(cls.key(lottery))
+        return index
+
+    def apply(self, data, op):
+        if op["op"] == "purchase":
+            lottery = data["active_lotteries"][op["lottery_id"]]
+            # Первая покупка пользователя в этом розыгрыше
+            if lottery["tickets"].count(op["user_id"]) == len(op["tickets"]):
+                bisect.insort(self.lotteries.setdefault(op["user_id"], []), self.key(lottery))
+
+    def count(self, user_id):
+        return len(self.lotteries.get(user_id, ()))
+
+    def page(self, user_id, limit, older_than=None, newer_than=None):
+        """Розыгрыши пользователя, новые первыми.
+
+        older_than / newer_than — ключ розыгрыша, от которого берется
+        страница; без них — самые новые. Возвращает (ID розыгрышей,
+        сколько розыгрышей новее страницы, сколько старее).
+        """
+        keys = self.lotteries.get(user_id, [])
+        if newer_than is not None:
+            start = bisect.bisect_right(keys, newer_than)
+            end = min(len(keys), start + limit)
+        else:
+            end = len(keys) if older_than is None else bisect.bisect_left(keys, older_than)
+            start = max(0, end - limit)
+        return [lottery_id for _, lottery_id in reversed(keys[start:end])], len(keys) - end, start
+
+# ========================
+# 🔒 БЛОКИРОВКИ
+# ========================
+
+class KeyedLocks:
+    """Асинхронные блокировки по ключу (розыгрыш, пользователь).
+
+    Несвязанные покупки идут параллельно, конфликтующие — по очереди.
+    Ключи берутся в отсортированном порядке, чтобы не было взаимных
+    блокировок; неиспользуемые блокировки удаляются.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        held = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._release(key, locked=False)
+                    raise
+                held.append(key)
+            yield
+        finally:
+            for key in reversed(held):
+                self._release(key, locked=True)
+
+    def _release(self, key, locked):
+        entry = self._locks[key]
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
+
+class StateStore:
+    """Хранилище состояния: читаем из памяти, пишем в backend в фоне.
+
+    Состояние загружается один раз при старте. Изменения сразу видны
+    обработчикам. Backend с group commit пишет сразу, объединяя
+    одновременные операции в одну запись; остальные сбрасываются раз
+    в flush_interval секунд или когда накопилось flush_threshold операций.
+    """
+
+    def __init__(self, backend, flush_interval=5.0, flush_threshold=100, archive=None, ledger=None):
+        self.backend = backend
+        self.archive = archive
+        self.ledger = ledger
+        self.flush_interval = flush_interval
+        self.flush_threshold = 1 if backend.group_commit else flush_threshold
+        self.data = empty_state()
+        self.aggregates = Aggregates()
+        self.user_tickets = UserTicketIndex()
+        # Версии для кэшей отрисовки: список розыгрышей, продажи и
+        # продажи по каждому розыгрышу
+        self.catalog_version = 0
+        self.sales_version = 0
+        self.lottery_versions = {}
+        self.pending = []
+        self.waiters = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._compactor = None
+        self._archiver = None
+        self.to_archive = []
+        # Кому сообщать о каждой примененной операции (рассылка репликам)
+        self.listeners = []
+        # Реплика в воркере шардированного режима: меняется только
+        # операциями владельца и на диск не пишет
+        self.replica = False
+
+    @property
+    def dirty(self):
+        return len(self.pending)
+
+    def load(self):
+        """Загружаем состояние из backend"""
+        with STORAGE_SECONDS.time("load"):
+            self.data = self.backend.load()
+        if self.ledger:
+            self.ledger.open(self.data)
+        self.aggregates = Aggregates.from_state(self.data)
+        self.user_tickets = UserTicketIndex.from_state(self.data)
+        self.pending = []
+        return self.data
+
+    def warm(self):
+        """Готовим производные данные сразу после загрузки, а не на первом запросе"""
+        with STORAGE_SECONDS.time("warm"):
+            for section in ("active_lotteries", "ended_lotteries"):
+                for lottery in self.data[section].values():
+                    if "tickets" in lottery:
+                        lottery["tickets"].warm()
+
+    def load_replica(self, data):
+        """Становимся репликой со снимком состояния владельца"""
+        self.replica = True
+        self.data = data
+        self.aggregates = Aggregates.from_state(data)
+        self.user_tickets = UserTicketIndex.from_state(data)
+        self.pending = []
+        return data
+
+    def replicate(self, op):
+        """Применяем в реплике операцию владельца"""
+        expected = self.data.get("seq", 0) + 1
+        if op["seq"] != expected:
+            raise ValueError(f"Пропуск в потоке операций: пришла {op['seq']}, ждали {expected}")
+        self._apply(op)
+
+    def _apply(self, op):
+        apply_op(self.data, op)
+        self.aggregates.apply(self.data, op)
+        self.user_tickets.apply(self.data, op)
+        if op["op"] in ("create_lottery", "close_lottery"):
+            self.catalog_version += 1
+        if op["op"] in ("purchase", "close_lottery"):
+            self.sales_version += 1
+            self.lottery_versions[op["lottery_id"]] = self.lottery_versions.get(op["lottery_id"], 0) + 1
+        for listener in self.listeners:
+            listener(op)
+
+    def commit(self, op):
+        """Применяем операцию и ставим ее в очередь на запись.
+
+        Возвращает future, который завершится после записи операции.
+        В режиме write-behind он завершен сразу.
+        """
+        if self.replica:
+            raise RuntimeError("Реплика состояния меняется только владельцем")
+        op["seq"] = self.data.get("seq", 0) + 1
+        self._apply(op)
+        self.pending.append(op)
+        if len(self.pending) >= self.flush_threshold:
+            self._wakeup.set()
+
+        future = asyncio.get_running_loop().create_future()
+        if self.backend.group_commit:
+            self.waiters.append(future)
+        else:
+            future.set_result(None)
+        return future
+
+    def find_lottery(self, lottery_id):
+        """Розыгрыш по ID среди активных и завершенных"""
+        return self.data["active_lotteries"].get(lottery_id) or self.data["ended_lotteries"].get(lottery_id)
+
+    async def full_lottery(self, lottery_id):
+        """Розыгрыш со всеми билетами; архивные читаются с диска"""
+        lottery = self.find_lottery(lottery_id)
+        if lottery is not None and lottery.get("archived"):
+            return await self.archive.load(lottery_id)
+        return lottery
+
+    def archive_later(self, *lottery_ids):
+        """Переносим завершенные розыгрыши в архив в фоне, по одному"""
+        if self.archive is None:
+            return
+        self.to_archive.extend(lottery_ids)
+        if self._archiver is None:
+            self._archiver = asyncio.create_task(self._archive_loop())
+
+    async def _archive_loop(self):
+        try:
+            while self.to_archive:
+                lottery_id = self.to_archive.pop(0)
+                lottery = self.data["ended_lotteries"].get(lottery_id)
+                if lottery is None or lottery.get("archived"):
+                    continue
+                try:
+                    # Завершенный розыгрыш больше не меняется, пишем его из потока
+                    await asyncio.to_thread(self.archive.write, lottery)
+                except Exception:
+                    logger.exception(f"❌ Не удалось заархивировать розыгрыш {lottery_id}")
+                    continue
+                self.commit({"op": "archive_lottery", "lottery_id": lottery_id})
+                logger.info(f"🗃️ Розыгрыш {lottery_id} перенесен в архив")
+        finally:
+            self._archiver = None
+
+    def check_aggregates(self):
+        """Сверяем счетчики с пересчетом с нуля и чиним расхождения"""
+        fresh = Aggregates.from_state(self.data)
+        mismatches = self.aggregates.diff(fresh)
+        if mismatches:
+            logger.warning(f"⚠️ Счетчики разошлись с данными: {mismatches}")
+            self.aggregates = fresh
+        return mismatches
+
+    async def reconcile_ledger(self):
+        """Сверяем балансы пользователей с суммами по журналу балансов.
+
+        Балансы снимаются в памяти, затем все операции до этого момента
+        сбрасываются на диск, и журнал читается в потоке до того же seq.
+        Возвращает {user_id: (баланс, сумма по журналу)} для расхождений.
+        """
+        seq = self.data.get("seq", 0)
+        balances = {user_id: user["balance"] for user_id, user in self.data["users"].items()}
+        await self.flush()
+        with STORAGE_SECONDS.time("reconcile"):
+            totals = await asyncio.to_thread(self.ledger.balances, seq)
+        mismatches = {
+            user_id: (balances.get(user_id, 0), totals.get(user_id, 0))
+            for user_id in balances.keys() | totals.keys()
+            if balances.get(user_id, 0) != totals.get(user_id, 0)
+        }
+        if mismatches:
+            logger.warning(f"⚠️ Балансы разошлись с журналом балансов: {len(mismatches)} пользователей")
+        return mismatches
+
+    # ---- запись на диск ----
+
+    async def flush(self):
+        """Сбрасываем накопленные изменения в backend"""
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self.pending:
+            return
+        ops, self.pending = self.pending, []
+        waiters, self.waiters = self.waiters, []
+        try:
+            with STORAGE_SECONDS.time("prepare"):
+                payload = self.backend.prepare(self.data, ops)
+                entries = [entry for op in ops for entry in ledger_entries(op)] if self.ledger else []
+        except BaseException:
+            self.pending[:0] = ops
+            self.waiters[:0] = waiters
+            raise
+
+        write = asyncio.ensure_future(asyncio.to_thread(self._write, entries, payload))
+        cancelled = False
+        with STORAGE_SECONDS.time("write"):
+            while not write.done():
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # Поток записи отменой не остановить: ждем его под той же
+                    # блокировкой, иначе операции вернулись бы в очередь и
+                    # записались второй раз, возможно параллельно с ним
+                    cancelled = True
+                except Exception:
+                    pass
+        if write.exception() is not None:
+            self.pending[:0] = ops
+            self.waiters[:0] = waiters
+            raise write.exception()
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+        if cancelled:
+            raise asyncio.CancelledError
+
+    def _write(self, entries, payload):
+        # Журнал балансов раньше состояния: состояние не должно его обгонять
+        if entries:
+            self.ledger.append(entries)
+        self.backend.write(payload)
+
+    async def compact(self):
+        """Сворачиваем журнал в снимок"""
+        async with self._flush_lock:
+            # Снимок не должен обгонять журнал: операции, пришедшие за время
+            # записи, тоже дописываем, иначе после усечения журнала они
+            # останутся только в снимке, неподтвержденными
+            while self.pending:
+                await self._flush()
+            with STORAGE_SECONDS.time("snapshot"):
+                payload = self.backend.snapshot(self.data)
+            with STORAGE_SECONDS.time("compact"):
+                await asyncio.to_thread(self.backend.compact, payload)
+        logger.info(f"🗜️ Журнал свернут в снимок (seq {self.data.get('seq', 0)})")
+
+    async def _flush_loop(self):
+        while True:
+            # asyncio.wait, а не wait_for: wait_for в 3.11 может проглотить отмену
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait([waiter], timeout=self.flush_interval)
+            finally:
+                waiter.cancel()
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("❌ Ошибка фоновой записи состояния")
+                await asyncio.sleep(1)
+                continue
+            if getattr(self.backend, "should_compact", False) and not self._compactor:
+                self._compactor = asyncio.create_task(self._compact_in_background())
+
+    async def _compact_in_background(self):
+        try:
+            await self.compact()
+        except Exception:
+            logger.exception("❌ Ошибка сворачивания журнала")
+        finally:
+            self._compactor = None
+
+    async def start(self):
+        """Запускаем фоновую запись"""
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливаем фоновую запись и сбрасываем все на диск"""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._archiver:
+            # Текущий розыгрыш дописываем, остальные подождут следующего запуска
+            self.to_archive.clear()
+            await asyncio.shield(self._archiver)
+        if self._compactor:
+            # Сворачивание не прерываем: оно подменяет файл журнала
+            await asyncio.shield(self._compactor)
+        await self.flush()
+        self.backend.close()
+        logger.info("💾 Состояние сохранено")
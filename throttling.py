@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+from metrics import Counter
+from outbox import TokenBucket
+
+# ========================
+# 🚦 ОГРАНИЧЕНИЕ ЧАСТОТЫ
+# ========================
+
+THROTTLED = Counter("lottery_throttled_total", "Апдейты, отброшенные ограничением частоты", ["handler"])
+
+def parse_limit(value):
+    """'rate/burst' -> (rate, burst)"""
+    rate, _, burst = value.partition("/")
+    rate = float(rate)
+    burst = float(burst) if burst else max(1.0, rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError(value)
+    return rate, burst
+
+def parse_limits(value):
+    """'handler=rate/burst,...' -> {handler: (rate, burst)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        handler, _, limit = item.partition("=")
+        limits[handler.strip()] = parse_limit(limit)
+    return limits
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Свой token bucket на каждую пару (пользователь, обработчик).
+
+    Внутренний middleware роутера: обработчик уже выбран, поэтому
+    лимит у «купить билет» может быть строже, чем у остальных кнопок.
+    Лишние нажатия получают быстрый callback.answer() и до обработчика
+    и хранилища не доходят, лишние сообщения просто отбрасываются.
+    Бакеты лежат в LRU не больше max_buckets штук.
+    """
+
+    def __init__(self, default, limits=None, max_buckets=100000, exempt=()):
+        self.default = default
+        self.limits = dict(limits or {})
+        self.max_buckets = max_buckets
+        self.exempt = set(exempt)
+        self.buckets = OrderedDict()
+        self.rejected = {}
+
+    def limit(self, handler):
+        return self.limits.get(handler, self.default)
+
+    def set_limit(self, handler, limit):
+        """Новый лимит; handler == 'default' меняет общий"""
+        if handler == "default":
+            self.default = limit
+        else:
+            self.limits[handler] = limit
+        # Старые бакеты помнят прежний лимит
+        self.buckets.clear()
+
+    def allow(self, user_id, handler, now=None):
+        now = now or time.monotonic()
+        key = (user_id, handler)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.limit(handler))
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        if bucket.delay(now) > 0:
+            return False
+        bucket.take(now)
+        return True
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        name = data["handler"].callback.__name__
+        if user is None or user.id in self.exempt or self.allow(user.id, name):
+            return await handler(event, data)
+
+        self.rejected[name] = self.rejected.get(name, 0) + 1
+        THROTTLED.inc(name)
+        if isinstance(event, CallbackQuery):
+            await event.answer("⏳ Слишком часто! Подожди секунду")
@@ -0,0 +1,147 @@
+from array import array
+from collections import Counter
+from datetime import datetime
+
+# ========================
+# 🎟️ ТАБЛИЦА БИЛЕТОВ
+# ========================
+#
+# Билеты розыгрыша хранятся параллельными массивами: номер, индекс
+# участника и время покупки (unix-время). Имя и username участника
+# берутся из users, а участники и их номера выводятся из массивов,
+# поэтому билет стоит ~24 байта вместо словаря на сотни байт.
+#
+# Позиция билета — его порядковый номер в розыгрыше, по ней же
+# выбираются победители.
+
+class TicketTable:
+    """Билеты одного розыгрыша в порядке покупки"""
+
+    def __init__(self):
+        self.members = []              # индекс участника -> user_id
+        self.member_index = {}         # user_id -> индекс участника
+        self.numbers = array('q')      # номер билета
+        self.users = array('I')        # индекс участника
+        self.times = array('q')        # время покупки
+        # Производные данные, в файл не пишутся: число билетов участника
+        # и цепочка его билетов, чтобы номера доставались за O(его билетов).
+        # После загрузки цепочки строятся при первом обращении
+        self.counts = array('I')
+        self.next = array('i')
+        self.heads = array('i')
+        self.tails = array('i')
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def _member(self, user_id):
+        index = self.member_index.get(user_id)
+        if index is None:
+            index = self.member_index[user_id] = len(self.members)
+            self.members.append(user_id)
+            self.counts.append(0)
+            if self.next is not None:
+                self.heads.append(-1)
+                self.tails.append(-1)
+        return index
+
+    def _link(self, member, position):
+        self.next.append(-1)
+        if self.tails[member] < 0:
+            self.heads[member] = position
+        else:
+            self.next[self.tails[member]] = position
+        self.tails[member] = position
+
+    def _build_chains(self):
+        self.next = array('i')
+        self.heads = array('i', [-1]) * len(self.members)
+        self.tails = array('i', [-1]) * len(self.members)
+        for position, member in enumerate(self.users):
+            self._link(member, position)
+
+    def warm(self):
+        """Строим цепочки сразу, чтобы их не ждал первый запрос номеров"""
+        if self.next is None:
+            self._build_chains()
+
+    def append(self, user_id, numbers, purchased_at):
+        """Добавляем билеты одной покупки"""
+        member = self._member(user_id)
+        for number in numbers:
+            position = len(self.numbers)
+            self.numbers.append(number)
+            self.users.append(member)
+            self.times.append(purchased_at)
+            self.counts[member] += 1
+            if self.next is not None:
+                self._link(member, position)
+
+    # ---- чтение ----
+
+    def user_at(self, position):
+        """Владелец билета на позиции"""
+        return self.members[self.users[position]]
+
+    def count(self, user_id):
+        """Сколько билетов у пользователя"""
+        member = self.member_index.get(user_id)
+        return 0 if member is None else self.counts[member]
+
+    def numbers_of(self, user_id, limit=None):
+        """Номера билетов пользователя в порядке покупки"""
+        member = self.member_index.get(user_id)
+        if member is None:
+            return []
+        if self.next is None:
+            self._build_chains()
+        result = []
+        position = self.heads[member]
+        while position >= 0 and (limit is None or len(result) < limit):
+            result.append(self.numbers[position])
+            position = self.next[position]
+        return result
+
+    def ticket_counts(self):
+        """{user_id: число билетов}"""
+        return {user_id: self.counts[member] for member, user_id in enumerate(self.members)}
+
+    # ---- сериализация ----
+
+    def to_json(self):
+        return {
+            "members": self.members,
+            "numbers": self.numbers.tolist(),
+            "users": self.users.tolist(),
+            "times": self.times.tolist()
+        }
+
+    @classmethod
+    def from_columns(cls, members, numbers, users, times):
+        """Из колонок: списков или готовых array"""
+        table = cls()
+        table.members = list(members)
+        table.member_index = {user_id: index for index, user_id in enumerate(table.members)}
+        table.numbers = numbers if isinstance(numbers, array) else array('q', numbers)
+        table.users = users if isinstance(users, array) else array('I', users)
+        table.times = times if isinstance(times, array) else array('q', times)
+        counts = Counter(table.users)
+        table.counts = array('I', (counts.get(member, 0) for member in range(len(table.members))))
+        table.next = table.heads = table.tails = None
+        return table
+
+    @classmethod
+    def from_json(cls, value):
+        """Из to_json или из старого списка словарей-билетов"""
+        if isinstance(value, dict):
+            return cls.from_columns(value["members"], value["numbers"], value["users"], value["times"])
+        table = cls()
+        for ticket in value:
+            table.append(ticket["user_id"], (ticket["number"],), purchase_epoch(ticket.get("purchased_at")))
+        return table
+
+def purchase_epoch(purchased_at):
+    """ISO-время покупки -> unix-время"""
+    if not purchased_at:
+        return 0
+    return int(datetime.fromisoformat(purchased_at).timestamp())